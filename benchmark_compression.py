@@ -0,0 +1,378 @@
+from datetime import datetime
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import itertools
+import threading
+import subprocess
+import numpy
+import tifffile
+import file_transfer
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak memory is not reported there
+    resource = None
+
+THROTTLE_CHUNK_BYTES = 1024 * 1024
+CACHE_SAMPLING_INTERVAL_SEC = 0.2
+
+
+def generate_dataset(dataset_dir, num_files, file_size_mb, pages, dtype, noise, empty_fraction, seed):
+    """
+    Writes 'num_files' uncompressed synthetic TIFF stacks, written page by page to keep memory use low.
+    Every page is a smooth image of blobs on a dark background: 'empty_fraction' of the rows are left at zero,
+    which makes the data more compressible, and Gaussian noise with a standard deviation of 'noise' times
+    the dtype range is added on top, which makes it less compressible.
+    """
+    os.makedirs(dataset_dir, exist_ok=True)
+    dtype = numpy.dtype(dtype)
+    side = max(16, int((file_size_mb * 1024 * 1024 / pages / dtype.itemsize) ** 0.5))
+    value_range = numpy.iinfo(dtype).max if dtype.kind in 'ui' else 1.0
+    rng = numpy.random.default_rng(seed)
+    y, x = numpy.mgrid[0:side, 0:side] / side
+
+    def iter_pages():
+        for _ in range(pages):
+            page = numpy.zeros((side, side), numpy.float64)
+            for cy, cx, radius in rng.uniform(0.05, 0.95, size=(8, 3)):
+                page += numpy.exp(-((y - cy) ** 2 + (x - cx) ** 2) / (0.1 * radius) ** 2)
+            page *= 0.5 * value_range
+            page += rng.normal(0, noise * value_range, page.shape)
+            page[:int(side * empty_fraction)] = 0
+            yield numpy.clip(page, 0, value_range).astype(dtype)
+
+    file_paths = []
+    for index in range(num_files):
+        file_path = os.path.join(dataset_dir, f"synthetic_{index:04d}.tif")
+        with tifffile.TiffWriter(file_path) as tiff:
+            # Without 'minisblack' tifffile stores 3 or 4 pages as a single RGB(A) page
+            tiff.write(iter_pages(), shape=(pages, side, side), dtype=dtype, photometric='minisblack')
+        file_paths.append(file_path)
+    return file_paths
+
+
+class ThrottledRemote:
+    """
+    Makes a local directory behave like a network share for file_transfer and shutil copies and moves in this process.
+    Every file operation touching 'remote_dir' waits 'latency_ms', and data copied to or from it
+    shares a single link of 'bandwidth_mb_s'. Moves within the remote directory only pay the latency.
+    All file_transfer copies count as remote, the pipeline only uses them to copy to and from the share.
+    file_transfer moves between the remote directory and elsewhere are throttled copies, as they would be between
+    a local disk and a share, although both directories are on the same filesystem here.
+    """
+
+    def __init__(self, remote_dir, bandwidth_mb_s, latency_ms):
+        self.remote_dir = os.path.abspath(remote_dir)
+        self.bandwidth = bandwidth_mb_s * 1024 * 1024 if bandwidth_mb_s else None
+        self.latency = latency_ms / 1000.0
+        self.link_lock = threading.Lock()
+        self.link_free_at = 0.0
+
+    def __enter__(self):
+        self.original_copyfile = shutil.copyfile
+        self.original_move = shutil.move
+        self.original_transfer_copy_file = file_transfer.copy_file
+        self.original_copy_range = file_transfer._copy_range
+        self.original_move_file = file_transfer.move_file
+        shutil.copyfile = self.copyfile
+        shutil.move = self.move
+        file_transfer.copy_file = self.transfer_copy_file
+        file_transfer._copy_range = self.copy_range
+        file_transfer.move_file = self.transfer_move_file
+        return self
+
+    def __exit__(self, *exc_info):
+        shutil.copyfile = self.original_copyfile
+        shutil.move = self.original_move
+        file_transfer.copy_file = self.original_transfer_copy_file
+        file_transfer._copy_range = self.original_copy_range
+        file_transfer.move_file = self.original_move_file
+
+    def is_remote(self, path):
+        return os.path.abspath(path).startswith(self.remote_dir + os.sep)
+
+    def _use_link(self, nbytes):
+        # Reserve the time it takes to send 'nbytes' on the shared link, then wait until it is over
+        with self.link_lock:
+            start = max(time.perf_counter(), self.link_free_at)
+            self.link_free_at = start + nbytes / self.bandwidth
+            wait_until = self.link_free_at
+        delay = wait_until - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+    def transfer_copy_file(self, src, dst, **kwargs):
+        time.sleep(self.latency)
+        return self.original_transfer_copy_file(src, dst, **kwargs)
+
+    def transfer_move_file(self, src, dst, **kwargs):
+        if not self.is_remote(src) and not self.is_remote(dst):
+            return self.original_move_file(src, dst, **kwargs)
+        if self.is_remote(src) and self.is_remote(dst):
+            time.sleep(self.latency)
+            return self.original_move_file(src, dst, **kwargs)
+        # A rename would skip the link, copy the file like a move between a local disk and a share does
+        self.transfer_copy_file(src, dst, **kwargs)
+        os.remove(src)
+        return dst
+
+    def copy_range(self, src_fd, dst_fd, offset, count):
+        copied = self.original_copy_range(src_fd, dst_fd, offset, min(count, THROTTLE_CHUNK_BYTES))
+        if self.bandwidth:
+            self._use_link(copied)
+        return copied
+
+    def copyfile(self, src, dst, *, follow_symlinks=True):
+        if not self.is_remote(src) and not self.is_remote(dst):
+            return self.original_copyfile(src, dst, follow_symlinks=follow_symlinks)
+        time.sleep(self.latency)
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            while True:
+                chunk = fsrc.read(THROTTLE_CHUNK_BYTES)
+                if not chunk:
+                    break
+                if self.bandwidth:
+                    self._use_link(len(chunk))
+                fdst.write(chunk)
+        return dst
+
+    def move(self, src, dst, copy_function=shutil.copy2):
+        if not self.is_remote(src) and not self.is_remote(dst):
+            return self.original_move(src, dst, copy_function=copy_function)
+        time.sleep(self.latency)
+        if self.is_remote(src) and self.is_remote(dst):
+            return self.original_move(src, dst, copy_function=copy_function)
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.basename(src))
+        copy_function(src, dst)
+        os.unlink(src)
+        return dst
+
+
+class CacheSampler:
+    """Samples the total size of the files in the cache directory in a background thread."""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.samples = []
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self.stop_event.wait(CACHE_SAMPLING_INTERVAL_SEC):
+            total = 0
+            for entry in os.scandir(self.cache_dir):
+                try:
+                    if entry.is_file():
+                        total += entry.stat().st_size
+                except OSError:
+                    pass
+            self.samples.append(total)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop_event.set()
+        self.thread.join()
+
+
+def peak_rss_bytes():
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return scale * max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                       resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def stage_seconds(remote_dir):
+    """Sums the time spent per pipeline stage, as recorded in the manifest of the run."""
+    from compression_manifest import MANIFEST_FILE
+    connection = sqlite3.connect(os.path.join(remote_dir, MANIFEST_FILE))
+    try:
+        copy_sec, compress_sec, upload_sec, original, compressed = connection.execute(
+            "SELECT COALESCE(SUM(copy_sec), 0), COALESCE(SUM(compress_sec), 0), COALESCE(SUM(upload_sec), 0), "
+            "COALESCE(SUM(original_size), 0), COALESCE(SUM(compressed_size), 0) FROM files").fetchone()
+    finally:
+        connection.close()
+    return {'copy': copy_sec, 'compress': compress_sec, 'upload': upload_sec}, original, compressed
+
+
+def run_configuration(config):
+    """Runs the caching pipeline once on a fresh copy of the dataset. Meant to run in its own process."""
+    # Imported here, in a fresh process, so the time includes the cold start of the script's dependencies
+    import_start = time.perf_counter()
+    import full_caching_compress_tiffs
+    import_sec = time.perf_counter() - import_start
+
+    remote_dir = config['remote_dir']
+    cache_dir = config['cache_dir']
+    shutil.rmtree(remote_dir, ignore_errors=True)
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    shutil.copytree(config['dataset_dir'], remote_dir)
+    os.makedirs(cache_dir)
+    input_bytes = sum(entry.stat().st_size for entry in os.scandir(remote_dir))
+    num_files = len(os.listdir(remote_dir))
+
+    workers = config['workers']
+    threads = full_caching_compress_tiffs.split_cpu_cores(workers, config['threads'])
+    with ThrottledRemote(remote_dir, config['bandwidth_mb_s'], config['latency_ms']), \
+            CacheSampler(cache_dir) as sampler:
+        start = time.perf_counter()
+        full_caching_compress_tiffs.compress_tiff_files(
+            remote_dir, cache_dir, config['quality'], config['codec'], threads, True,
+            workers=workers, cache_budget_gb=config['cache_budget_gb'], upload_workers=config['upload_workers'],
+            input_location="remote")
+        wall_sec = time.perf_counter() - start
+
+    stages, original_bytes, compressed_bytes = stage_seconds(remote_dir)
+    return {
+        'config': {key: config[key] for key in configuration_key_names()},
+        'wall_sec': wall_sec,
+        'import_sec': import_sec,
+        'files_per_sec': num_files / wall_sec,
+        # Dominated by the fixed cost of every file on datasets of many small files
+        'ms_per_file': 1000 * wall_sec / num_files,
+        'mb_per_sec': input_bytes / 1024 ** 2 / wall_sec,
+        'peak_rss_mb': peak_rss_bytes() / 1024 ** 2 if resource is not None else None,
+        'cache_peak_mb': max(sampler.samples, default=0) / 1024 ** 2,
+        'cache_mean_mb': sum(sampler.samples) / max(1, len(sampler.samples)) / 1024 ** 2,
+        # Busy time of a stage divided by the wall time, can be above 1 for stages running in parallel
+        'stage_utilisation': {stage: seconds / wall_sec for stage, seconds in stages.items()},
+        'compression_ratio': original_bytes / compressed_bytes if compressed_bytes else None,
+    }
+
+
+def configuration_key_names():
+    return ('codec', 'threads', 'workers', 'upload_workers', 'cache_budget_gb')
+
+
+def configuration_key(result):
+    return tuple(result['config'][name] for name in configuration_key_names())
+
+
+def compare_results(previous_file, results, regression_threshold):
+    """Prints the MB/s change of every configuration found in both runs. Returns the number of regressions."""
+    with open(previous_file, 'r') as f:
+        previous = {configuration_key(result): result for result in json.load(f)['results']}
+    regressions = 0
+    for result in results:
+        old = previous.get(configuration_key(result))
+        if old is None:
+            continue
+        change = result['mb_per_sec'] / old['mb_per_sec'] - 1
+        regressed = change < -regression_threshold
+        regressions += regressed
+        print(f"{configuration_key(result)}: {round(old['mb_per_sec'], 1)} -> {round(result['mb_per_sec'], 1)} MB/s "
+              f"({round(100 * change, 1)}%){' REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark full_caching_compress_tiffs.py on synthetic TIFFs with a throttled stand-in for the share.")
+    parser.add_argument('--work_dir', type=str, default=None,
+                        help="Directory for the dataset, remote and cache directories (default: a temporary one).")
+    parser.add_argument('--output', type=str, default=None,
+                        help="JSON file for the results (default: benchmark-<date>.json).")
+    parser.add_argument('--compare', type=str, default=None,
+                        help="Results of an earlier run to compare with. Exits with an error on regressions.")
+    parser.add_argument('--regression_threshold', type=float, default=0.1,
+                        help="Relative MB/s drop that counts as a regression (default: 0.1).")
+    parser.add_argument('--verbose', action="store_true", default=False, help="Show the output of the pipeline.")
+
+    dataset = parser.add_argument_group("Synthetic dataset")
+    dataset.add_argument('--num_files', type=int, default=8)
+    dataset.add_argument('--file_size_mb', type=float, default=64)
+    dataset.add_argument('--pages', type=int, default=16)
+    dataset.add_argument('--dtype', choices=['uint8', 'uint16', 'float32'], default='uint16')
+    dataset.add_argument('--noise', type=float, default=0.01,
+                         help="Standard deviation of the added noise, relative to the dtype range.")
+    dataset.add_argument('--empty_fraction', type=float, default=0.5,
+                         help="Fraction of every page left empty, higher is more compressible.")
+    dataset.add_argument('--seed', type=int, default=0)
+
+    remote = parser.add_argument_group("Throttled remote")
+    remote.add_argument('--bandwidth_mb_s', type=float, default=100, help="0 disables bandwidth throttling.")
+    remote.add_argument('--latency_ms', type=float, default=5)
+
+    matrix = parser.add_argument_group("Configurations, every combination is run")
+    matrix.add_argument('--codecs', nargs='+', default=['zlib', 'lzw'])
+    matrix.add_argument('--quality', type=int, default=85)
+    matrix.add_argument('--threads', nargs='+', type=int, default=[0],
+                        help="Codec threads per file, 0 splits the CPU cores between workers.")
+    matrix.add_argument('--workers', nargs='+', type=int, default=[1])
+    matrix.add_argument('--upload_workers', nargs='+', type=int, default=[2])
+    matrix.add_argument('--cache_budget_gb', nargs='+', type=float, default=[0],
+                        help="0 uses the default budget.")
+
+    parser.add_argument('--run_config', type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--result_file', type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_config:
+        result = run_configuration(json.loads(args.run_config))
+        with open(args.result_file, 'w') as f:
+            json.dump(result, f)
+        return
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="tiff_compression_benchmark_")
+    dataset_dir = os.path.join(work_dir, "dataset")
+    print(f"Generating {args.num_files} synthetic files of {args.file_size_mb} MB in {dataset_dir}")
+    shutil.rmtree(dataset_dir, ignore_errors=True)
+    generate_dataset(dataset_dir, args.num_files, args.file_size_mb, args.pages, args.dtype, args.noise,
+                     args.empty_fraction, args.seed)
+
+    results = []
+    for codec, threads, workers, upload_workers, cache_budget_gb in itertools.product(
+            args.codecs, args.threads, args.workers, args.upload_workers, args.cache_budget_gb):
+        config = {
+            'codec': codec, 'quality': args.quality, 'threads': threads or None, 'workers': workers,
+            'upload_workers': upload_workers, 'cache_budget_gb': cache_budget_gb or None,
+            'bandwidth_mb_s': args.bandwidth_mb_s, 'latency_ms': args.latency_ms,
+            'dataset_dir': dataset_dir, 'remote_dir': os.path.join(work_dir, "remote"),
+            'cache_dir': os.path.join(work_dir, "cache"),
+        }
+        result_file = os.path.join(work_dir, "result.json")
+        # Every configuration runs in a fresh process, so peak memory is measured per configuration
+        subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--run_config', json.dumps(config), '--result_file', result_file],
+            check=True, stdout=None if args.verbose else subprocess.DEVNULL,
+            stderr=None if args.verbose else subprocess.DEVNULL)
+        with open(result_file, 'r') as f:
+            result = json.load(f)
+        results.append(result)
+        print(f"{configuration_key(result)}: {round(result['files_per_sec'], 2)} files/s, "
+              f"{round(result['mb_per_sec'], 1)} MB/s, {round(result['ms_per_file'], 1)} ms per file, "
+              f"peak cache {round(result['cache_peak_mb'], 1)} MB, import {round(result['import_sec'], 2)} s")
+
+    output = args.output or "benchmark-%s.json" % datetime.now().strftime("%Y-%b-%d-%H%M%S")
+    with open(output, 'w') as f:
+        json.dump({
+            'created': datetime.now().isoformat(),
+            'tifffile_version': tifffile.__version__,
+            'cpu_count': os.cpu_count(),
+            'dataset': {name: getattr(args, name) for name in (
+                'num_files', 'file_size_mb', 'pages', 'dtype', 'noise', 'empty_fraction', 'seed')},
+            'remote': {'bandwidth_mb_s': args.bandwidth_mb_s, 'latency_ms': args.latency_ms},
+            'results': results,
+        }, f, indent=2)
+    print(f"Saved results to {output}")
+
+    if not args.work_dir:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if args.compare and compare_results(args.compare, results, args.regression_threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
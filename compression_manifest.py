@@ -0,0 +1,328 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import urllib.request
+
+MANIFEST_FILE = "_compression_manifest.sqlite"
+MANIFEST_COMMIT_BATCH = 100
+MANIFEST_COMMIT_INTERVAL_SEC = 10
+# Processes on one computer may still share a manifest, each waits this long for the others' commits
+MANIFEST_LOCK_TIMEOUT_SEC = 60
+
+STATUS_COMPRESSED = "compressed"
+STATUS_BELOW_THRESHOLD = "below_threshold"
+STATUS_ESTIMATED_BELOW_THRESHOLD = "estimated_below_threshold"
+STATUS_ERROR = "error"
+STATUS_IMPORTED = "imported"
+STATUS_ALREADY_COMPRESSED = "already_compressed"
+STATUS_NOT_AN_IMAGE = "not_an_image"
+STATUS_VERIFICATION_FAILED = "verification_failed"
+# Files with these statuses are not processed again, unless their size or modification time changed
+DONE_STATUSES = (STATUS_COMPRESSED, STATUS_BELOW_THRESHOLD, STATUS_ESTIMATED_BELOW_THRESHOLD, STATUS_IMPORTED,
+                 STATUS_ALREADY_COMPRESSED, STATUS_NOT_AN_IMAGE)
+
+RECORD_FIELDS = (
+    "size", "mtime", "codec", "ratio", "original_size", "compressed_size",
+    "copy_sec", "compress_sec", "upload_sec", "message", "pixel_hash", "compressed_pixel_hash", "verify_sec")
+# Columns added to the files table after its first version, added to older manifests when they are opened
+ADDED_COLUMNS = (("pixel_hash", "TEXT"), ("compressed_pixel_hash", "TEXT"), ("verify_sec", "REAL"))
+# TIFF header fields cached by the triage, see tiff_streaming.read_tiff_header
+HEADER_FIELDS = ("is_image", "compression", "dtype", "tiled", "pages")
+# Stored as PRAGMA user_version. 1: paths relative to the folder instead of absolute
+MANIFEST_SCHEMA_VERSION = 1
+
+
+def relative_key(root, path):
+    """
+    Returns the key of 'path' in the manifest of the folder 'root': the path relative to the folder, with '/'
+    separators, so hosts mounting the folder at different places or running other operating systems share the keys.
+    """
+    prefix = os.path.join(root, '')
+    relative = path[len(prefix):] if path.startswith(prefix) else os.path.relpath(path, root)
+    return relative.replace(os.sep, '/') if os.sep != '/' else relative
+
+
+def worker_manifest_path(cache_dir, folder):
+    """Returns the path of the manifest a cooperative worker keeps for 'folder' in its own cache directory."""
+    name, extension = os.path.splitext(MANIFEST_FILE)
+    digest = hashlib.sha1(os.path.abspath(folder).encode()).hexdigest()[:12]
+    return os.path.join(cache_dir, f"{name}_{digest}{extension}")
+
+
+def read_done_files(manifest_path, statuses=DONE_STATUSES):
+    """
+    Returns CompressionManifest.done_files of a manifest opened read-only, or an empty dict if there is none.
+    For cooperative workers, which must not write to the manifest of a folder on a network share.
+    """
+    if not os.path.exists(manifest_path):
+        return {}
+    uri = "file:" + urllib.request.pathname2url(os.path.abspath(manifest_path)) + "?mode=ro"
+    connection = sqlite3.connect(uri, uri=True, timeout=MANIFEST_LOCK_TIMEOUT_SEC)
+    try:
+        placeholders = ", ".join("?" * len(statuses))
+        rows = connection.execute(
+            f"SELECT path, size, mtime FROM files WHERE status IN ({placeholders})", tuple(statuses)).fetchall()
+    finally:
+        connection.close()
+    return {path: (size, mtime) for path, size, mtime in rows}
+
+
+class CompressionManifest:
+    """
+    SQLite index of processed files, keyed by path relative to 'root', the folder of the manifest by default.
+    Paths are passed in as they are found and turned into keys with relative_key, the dicts returned are keyed by it.
+    Stores size and modification time of every file after processing, so changed files are picked up again,
+    together with the codec, compression ratio, status and stage timings, and with verification the pixel hashes
+    of the original and the compressed file.
+    The TIFF headers read by the triage are cached in a second table, also keyed by path, size and modification time.
+    Codec settings picked automatically for a directory are kept in a third table, keyed by directory and target.
+    Records are committed in batches, call close() (or use it as a context manager) to write the last batch.
+    """
+
+    def __init__(self, manifest_path, root=None):
+        self.manifest_path = manifest_path
+        self.root = root if root is not None else os.path.dirname(os.path.abspath(manifest_path))
+        self.lock = threading.Lock()
+        self.pending = []
+        self.pending_headers = []
+        self.last_commit = time.monotonic()
+        self.connection = sqlite3.connect(manifest_path, timeout=MANIFEST_LOCK_TIMEOUT_SEC, check_same_thread=False)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                size INTEGER,
+                mtime REAL,
+                codec TEXT,
+                ratio REAL,
+                original_size INTEGER,
+                compressed_size INTEGER,
+                copy_sec REAL,
+                compress_sec REAL,
+                upload_sec REAL,
+                message TEXT,
+                pixel_hash TEXT,
+                compressed_pixel_hash TEXT,
+                verify_sec REAL,
+                updated REAL NOT NULL
+            )""")
+        columns = {row[1] for row in self.connection.execute("PRAGMA table_info(files)")}
+        for name, column_type in ADDED_COLUMNS:
+            if name not in columns:
+                self.connection.execute(f"ALTER TABLE files ADD COLUMN {name} {column_type}")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS files_status ON files (status)")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS headers (
+                path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime REAL,
+                is_image INTEGER,
+                compression INTEGER,
+                dtype TEXT,
+                tiled INTEGER,
+                pages INTEGER
+            )""")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS codec_choices (
+                directory TEXT NOT NULL,
+                target TEXT NOT NULL,
+                compression TEXT NOT NULL,
+                level INTEGER,
+                predictor INTEGER,
+                ratio REAL,
+                mb_per_sec REAL,
+                updated REAL NOT NULL,
+                PRIMARY KEY (directory, target)
+            )""")
+        self.connection.commit()
+        self._upgrade()
+
+    def _upgrade(self):
+        """Turns the absolute paths stored by older versions into keys, once, while other processes wait."""
+        if self.connection.execute("PRAGMA user_version").fetchone()[0] >= MANIFEST_SCHEMA_VERSION:
+            return
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            if self.connection.execute("PRAGMA user_version").fetchone()[0] < 1:
+                for table, column in (("files", "path"), ("headers", "path"), ("codec_choices", "directory")):
+                    for path, in self.connection.execute(f"SELECT DISTINCT {column} FROM {table}").fetchall():
+                        key = relative_key(self.root, path)
+                        # Paths outside the folder, like those of another mount point, cannot be told apart
+                        if os.path.isabs(path) and key != os.pardir and not key.startswith(os.pardir + '/'):
+                            self.connection.execute(
+                                f"UPDATE OR REPLACE {table} SET {column} = ? WHERE {column} = ?", (key, path))
+            self.connection.execute(f"PRAGMA user_version = {MANIFEST_SCHEMA_VERSION}")
+            self.connection.commit()
+        except BaseException:
+            self.connection.rollback()
+            raise
+
+    def key(self, path):
+        return relative_key(self.root, path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def import_text_manifest(self, done_paths_file):
+        """
+        Imports the paths listed in an old '_already_compressed_files' text file, once.
+        Size and modification time are taken from the files as they are now.
+        Returns the number of imported paths.
+        """
+        with self.lock:
+            if self.connection.execute("SELECT 1 FROM files LIMIT 1").fetchone() is not None:
+                return 0
+        if not os.path.exists(done_paths_file):
+            return 0
+        imported = 0
+        with open(done_paths_file, 'r') as file:
+            for line in file:
+                file_path = line.strip()
+                if not file_path:
+                    continue
+                try:
+                    stat = os.stat(file_path)
+                except OSError:
+                    continue
+                self.record(file_path, STATUS_IMPORTED, size=stat.st_size, mtime=stat.st_mtime)
+                imported += 1
+        self.commit()
+        return imported
+
+    def import_records(self, records):
+        """
+        Records results kept outside the manifest, like the records of cooperative workers (see work_leases), given
+        as dicts with the 'path' key relative to the folder, the 'status' and RECORD_FIELDS.
+        Returns the number of imported records.
+        """
+        imported = 0
+        for record in records:
+            path = os.path.join(self.root, *record['path'].split('/'))
+            self.record(path, record['status'], **{name: record.get(name) for name in RECORD_FIELDS})
+            imported += 1
+        self.commit()
+        return imported
+
+    def done_files(self, statuses=DONE_STATUSES):
+        """Returns a dict of key -> (size, mtime) for files that do not need to be processed again."""
+        placeholders = ", ".join("?" * len(statuses))
+        with self.lock:
+            rows = self.connection.execute(
+                f"SELECT path, size, mtime FROM files WHERE status IN ({placeholders})", tuple(statuses)).fetchall()
+        return {path: (size, mtime) for path, size, mtime in rows}
+
+    def is_done(self, path, size, mtime, statuses=DONE_STATUSES):
+        """Returns True if the file was processed with this size and modification time, including uncommitted records."""
+        placeholders = ", ".join("?" * len(statuses))
+        path = self.key(path)
+        with self.lock:
+            # The latest record of a path is its uncommitted one, looked up here so the batch is not committed early
+            for values in reversed(self.pending):
+                if values[0] == path:
+                    return values[1] in statuses and self.is_unchanged(tuple(values[2:4]), size, mtime)
+            row = self.connection.execute(
+                f"SELECT size, mtime FROM files WHERE path = ? AND status IN ({placeholders})",
+                (path, *statuses)).fetchone()
+        return self.is_unchanged(row, size, mtime)
+
+    @staticmethod
+    def is_unchanged(done_entry, size, mtime):
+        return done_entry is not None and done_entry == (size, mtime)
+
+    def record(self, path, status, **fields):
+        """Queues the result for one file, committing when the batch is full or old enough."""
+        unknown = set(fields) - set(RECORD_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown manifest fields: {', '.join(sorted(unknown))}")
+        values = [self.key(path), status] + [fields.get(name) for name in RECORD_FIELDS] + [time.time()]
+        with self.lock:
+            self.pending.append(values)
+            if (len(self.pending) >= MANIFEST_COMMIT_BATCH
+                    or time.monotonic() - self.last_commit >= MANIFEST_COMMIT_INTERVAL_SEC):
+                self._commit()
+
+    def cached_headers(self):
+        """Returns a dict of key -> (size, mtime, header) for every TIFF header read by the triage."""
+        with self.lock:
+            rows = self.connection.execute(
+                f"SELECT path, size, mtime, {', '.join(HEADER_FIELDS)} FROM headers").fetchall()
+        headers = {}
+        for path, size, mtime, *values in rows:
+            header = dict(zip(HEADER_FIELDS, values))
+            header['is_image'] = bool(header['is_image'])
+            header['tiled'] = None if header['tiled'] is None else bool(header['tiled'])
+            headers[path] = (size, mtime, header)
+        return headers
+
+    def record_header(self, path, size, mtime, header):
+        """Queues a TIFF header read by the triage, committed in batches like the file records."""
+        values = [self.key(path), size, mtime] + [header.get(name) for name in HEADER_FIELDS]
+        with self.lock:
+            self.pending_headers.append(values)
+            if (len(self.pending_headers) >= MANIFEST_COMMIT_BATCH
+                    or time.monotonic() - self.last_commit >= MANIFEST_COMMIT_INTERVAL_SEC):
+                self._commit()
+
+    def codec_choices(self, target):
+        """Returns a dict of directory key -> (compression, level, predictor) picked for 'target'."""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT directory, compression, level, predictor FROM codec_choices WHERE target = ?",
+                (target,)).fetchall()
+        return {directory: (compression, level, bool(predictor)) for directory, compression, level, predictor in rows}
+
+    def record_codec_choice(self, directory, target, codec_settings, ratio=None, mb_per_sec=None):
+        """Stores the codec settings picked for a directory right away, they are needed by every file in it."""
+        compression, level, predictor = codec_settings
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO codec_choices "
+                "(directory, target, compression, level, predictor, ratio, mb_per_sec, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (self.key(directory), target, compression, level, int(predictor), ratio, mb_per_sec, time.time()))
+            self.connection.commit()
+
+    def commit(self):
+        with self.lock:
+            self._commit()
+
+    def _commit(self):
+        if self.pending:
+            columns = ("path", "status") + RECORD_FIELDS + ("updated",)
+            self.connection.executemany(
+                f"INSERT OR REPLACE INTO files ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                self.pending)
+            self.connection.commit()
+            self.pending = []
+        if self.pending_headers:
+            columns = ("path", "size", "mtime") + HEADER_FIELDS
+            self.connection.executemany(
+                f"INSERT OR REPLACE INTO headers ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                self.pending_headers)
+            self.connection.commit()
+            self.pending_headers = []
+        self.last_commit = time.monotonic()
+
+    def total_bytes_saved(self):
+        with self.lock:
+            self._commit()
+            saved, = self.connection.execute(
+                "SELECT COALESCE(SUM(original_size - compressed_size), 0) FROM files WHERE status = ?",
+                (STATUS_COMPRESSED,)).fetchone()
+        return saved
+
+    def status_counts(self):
+        with self.lock:
+            self._commit()
+            rows = self.connection.execute("SELECT status, COUNT(*) FROM files GROUP BY status").fetchall()
+        return dict(rows)
+
+    def close(self):
+        with self.lock:
+            self._commit()
+            self.connection.close()
@@ -0,0 +1,82 @@
+import logging
+import os
+import queue
+import threading
+
+CRAWLER_THREADS = 16
+TIFF_EXTENSIONS = ('.tif', '.tiff')
+_CRAWL_DONE = object()
+
+
+class _Counter:
+    def __init__(self, value):
+        self.value = value
+        self.lock = threading.Lock()
+
+    def increment(self):
+        with self.lock:
+            self.value += 1
+
+    def decrement(self):
+        with self.lock:
+            self.value -= 1
+            return self.value
+
+
+def _scan_directories(dir_queue, results, pending, excluded_dirs, extensions, dir_mtimes):
+    while True:
+        directory = dir_queue.get()
+        if directory is None:
+            return
+        try:
+            if dir_mtimes is not None:
+                # Taken before the listing, so a change during the listing shows as a newer modification time later
+                dir_mtimes[directory] = os.stat(directory).st_mtime
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if entry.name not in excluded_dirs:
+                                pending.increment()
+                                dir_queue.put(entry.path)
+                        elif entry.name.endswith(extensions) and entry.is_file():
+                            # On Windows the stat result comes with the directory listing, without extra requests
+                            stat = entry.stat()
+                            results.put((entry.path, stat.st_size, stat.st_mtime))
+                    except OSError as e:
+                        logging.warning(f"Could not read {entry.path}: {e}")
+        except OSError as e:
+            logging.warning(f"Could not list directory {directory}: {e}")
+        finally:
+            if pending.decrement() == 0:
+                results.put(_CRAWL_DONE)
+
+
+def scan_tiff_files(root, excluded_dirs=(), threads=CRAWLER_THREADS, extensions=TIFF_EXTENSIONS, dir_mtimes=None):
+    """
+    Walks the directory tree under 'root' with several threads listing directories in parallel,
+    which hides the latency of network shares.
+    Yields (path, size, mtime) for every TIFF file as soon as it is found, in no particular order.
+    Directories named in 'excluded_dirs' are not entered.
+    If 'dir_mtimes' is a dict, the modification time of every directory listed is stored in it.
+    """
+    dir_queue = queue.Queue()
+    results = queue.Queue()
+    pending = _Counter(1)
+    dir_queue.put(root)
+    workers = []
+    for _ in range(threads):
+        worker = threading.Thread(
+            target=_scan_directories, args=(dir_queue, results, pending, set(excluded_dirs), extensions, dir_mtimes),
+            daemon=True)
+        worker.start()
+        workers.append(worker)
+    try:
+        while True:
+            result = results.get()
+            if result is _CRAWL_DONE:
+                break
+            yield result
+    finally:
+        for _ in workers:
+            dir_queue.put(None)
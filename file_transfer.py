@@ -0,0 +1,227 @@
+import errno
+import logging
+import os
+import shutil
+import sys
+import threading
+import time
+
+DEFAULT_TRANSFER_STREAMS = 4
+DEFAULT_TRANSFER_BLOCK_MB = 8
+# Files smaller than this are copied with a single stream
+PARALLEL_TRANSFER_MIN_BYTES = 64 * 1024 * 1024
+DEFAULT_RETRY_TIMEOUT_SEC = 600
+TRANSFER_RETRY_INTERVAL_SEC = 1
+# Errors that do not go away by waiting for the remote share to come back
+PERMANENT_ERRNOS = {errno.ENOSPC, errno.EACCES, errno.EPERM, errno.EISDIR, errno.EROFS, errno.EFBIG,
+                    getattr(errno, 'EDQUOT', errno.ENOSPC)}
+
+O_BINARY = getattr(os, 'O_BINARY', 0)
+
+# Kernel copy methods are switched off the first time the filesystems do not support them
+_fast_copy_supported = {
+    'copy_file_range': hasattr(os, 'copy_file_range'),
+    'sendfile': hasattr(os, 'sendfile') and sys.platform.startswith('linux'),
+}
+_FAST_COPY_UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL, errno.EBADF}
+
+
+def _write_all(dst_fd, data, offset):
+    written = 0
+    while written < len(data):
+        if hasattr(os, 'pwrite'):
+            written += os.pwrite(dst_fd, data[written:], offset + written)
+        else:
+            os.lseek(dst_fd, offset + written, os.SEEK_SET)
+            written += os.write(dst_fd, data[written:])
+
+
+def _copy_range(src_fd, dst_fd, offset, count):
+    """
+    Copies up to 'count' bytes at 'offset' from one file to the same offset in the other.
+    Uses copy_file_range or sendfile where the filesystems support them, so the data does not pass through Python.
+    Returns the number of bytes copied, 0 at the end of the source file.
+    """
+    if _fast_copy_supported['copy_file_range']:
+        try:
+            return os.copy_file_range(src_fd, dst_fd, count, offset, offset)
+        except OSError as e:
+            if e.errno not in _FAST_COPY_UNSUPPORTED_ERRNOS:
+                raise
+            _fast_copy_supported['copy_file_range'] = False
+    if _fast_copy_supported['sendfile']:
+        try:
+            os.lseek(dst_fd, offset, os.SEEK_SET)
+            return os.sendfile(dst_fd, src_fd, offset, count)
+        except OSError as e:
+            if e.errno not in _FAST_COPY_UNSUPPORTED_ERRNOS:
+                raise
+            _fast_copy_supported['sendfile'] = False
+    if hasattr(os, 'pread'):
+        data = os.pread(src_fd, count, offset)
+    else:
+        os.lseek(src_fd, offset, os.SEEK_SET)
+        data = os.read(src_fd, count)
+    _write_all(dst_fd, data, offset)
+    return len(data)
+
+
+def _copy_byte_range(src, dst, start, end, block_size, retry_timeout, errors):
+    """
+    Copies bytes [start, end) of 'src' into the preallocated 'dst' block by block.
+    If the transfer fails, for example because the remote share dropped out, both files are reopened
+    and the copy resumes from the last completed block, for up to 'retry_timeout' seconds.
+    """
+    offset = start
+    deadline = None
+    while offset < end:
+        try:
+            src_fd = os.open(src, os.O_RDONLY | O_BINARY)
+            try:
+                dst_fd = os.open(dst, os.O_WRONLY | O_BINARY)
+                try:
+                    while offset < end:
+                        if errors:
+                            # Another stream of this file failed for good
+                            return
+                        copied = _copy_range(src_fd, dst_fd, offset, min(block_size, end - offset))
+                        if copied == 0:
+                            raise EOFError(f"{src} is shorter than expected, it was probably changed during the copy.")
+                        offset += copied
+                        deadline = None
+                finally:
+                    os.close(dst_fd)
+            finally:
+                os.close(src_fd)
+        except OSError as e:
+            if e.errno in PERMANENT_ERRNOS:
+                errors.append(e)
+                return
+            if deadline is None:
+                deadline = time.monotonic() + retry_timeout
+                logging.warning(f"Transfer of {src} interrupted at byte {offset}, retrying: {e}")
+            if time.monotonic() > deadline:
+                errors.append(e)
+                return
+            time.sleep(TRANSFER_RETRY_INTERVAL_SEC)
+        except Exception as e:
+            errors.append(e)
+            return
+
+
+def copy_file(src, dst, streams=DEFAULT_TRANSFER_STREAMS, block_size=DEFAULT_TRANSFER_BLOCK_MB * 1024 * 1024,
+              retry_timeout=DEFAULT_RETRY_TIMEOUT_SEC):
+    """
+    Copies a file like shutil.copy2, but big files are split into 'streams' byte ranges copied in parallel,
+    in blocks of 'block_size' bytes. Interrupted transfers resume where they stopped instead of starting over.
+    Copying the file metadata is skipped where the destination does not support it (errno 95 on samba shares).
+    Returns the number of bytes copied.
+    """
+    size = os.path.getsize(src)
+    # Create the destination with its final size, so every stream can write its own range
+    dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | O_BINARY, 0o666)
+    try:
+        os.ftruncate(dst_fd, size)
+    finally:
+        os.close(dst_fd)
+
+    if size < PARALLEL_TRANSFER_MIN_BYTES:
+        streams = 1
+    range_size = max(1, -(-size // max(1, streams)))
+    ranges = [(start, min(size, start + range_size)) for start in range(0, size, range_size)]
+    errors = []
+    if len(ranges) == 1:
+        _copy_byte_range(src, dst, *ranges[0], block_size, retry_timeout, errors)
+    else:
+        threads = [threading.Thread(target=_copy_byte_range, args=(src, dst, start, end, block_size, retry_timeout, errors))
+                   for start, end in ranges]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+
+    try:
+        shutil.copystat(src, dst)
+    except OSError as e:
+        if e.errno not in (95, errno.EOPNOTSUPP):
+            raise
+    return size
+
+
+def copy_files(pairs, **copy_kwargs):
+    """
+    Copies several files at once, one thread per (src, dst) pair, so the round trips to the share overlap.
+    A single pair is copied in the calling thread. Returns the exception raised for every pair, None for the files that were copied.
+    """
+    errors = [None] * len(pairs)
+
+    def copy_one(index, src, dst):
+        try:
+            copy_file(src, dst, **copy_kwargs)
+        except Exception as e:
+            errors[index] = e
+
+    if len(pairs) == 1:
+        copy_one(0, *pairs[0])
+        return errors
+    threads = [threading.Thread(target=copy_one, args=(index, src, dst)) for index, (src, dst) in enumerate(pairs)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+def move_file(src, dst, **copy_kwargs):
+    """
+    Moves a file like shutil.move. Between filesystems the file is copied with copy_file and the source removed.
+    """
+    try:
+        os.replace(src, dst)
+        return dst
+    except OSError:
+        pass
+    copy_file(src, dst, **copy_kwargs)
+    os.remove(src)
+    return dst
+
+
+NETWORK_FILESYSTEMS = {'cifs', 'smb3', 'smbfs', 'nfs', 'nfs4', 'fuse.sshfs', 'sshfs', '9p', 'afs', 'ceph',
+                       'glusterfs', 'fuse.glusterfs', 'davfs', 'fuse.rclone', 'lustre', 'gpfs', 'beegfs'}
+
+
+def _linux_filesystem_type(path):
+    best_mount_point, best_type = "", None
+    with open('/proc/mounts', 'r') as mounts:
+        for line in mounts:
+            fields = line.split()
+            if len(fields) < 3:
+                continue
+            # Spaces and other special characters in mount points are escaped as octal
+            mount_point = fields[1].encode().decode('unicode_escape')
+            if (path == mount_point or path.startswith(mount_point.rstrip('/') + '/')) \
+                    and len(mount_point) > len(best_mount_point):
+                best_mount_point, best_type = mount_point, fields[2]
+    return best_type
+
+
+def is_local_path(path):
+    """
+    Returns True if 'path' is on a local disk, False if it is on a network share or the type of disk is unknown.
+    """
+    path = os.path.realpath(path)
+    if sys.platform == 'win32':
+        if path.startswith('\\\\'):
+            return False
+        import ctypes
+        drive_remote = 4
+        return ctypes.windll.kernel32.GetDriveTypeW(os.path.splitdrive(path)[0] + '\\') != drive_remote
+    if sys.platform.startswith('linux'):
+        try:
+            filesystem_type = _linux_filesystem_type(path)
+        except OSError:
+            return False
+        return filesystem_type is not None and filesystem_type not in NETWORK_FILESYSTEMS
+    return False
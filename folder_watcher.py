@@ -0,0 +1,271 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from directory_crawler import CRAWLER_THREADS, TIFF_EXTENSIONS, scan_tiff_files
+
+DEFAULT_POLL_INTERVAL_SEC = 60
+# A file is finished when its size and modification time did not change for this long
+DEFAULT_SETTLE_SEC = 30
+# How often a stop request is checked for while waiting for events
+STOP_CHECK_INTERVAL_SEC = 1
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+class _Inotify:
+    """Minimal inotify binding through ctypes, watching every directory of a tree for new and rewritten files."""
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.paths = {}
+
+    def add_tree(self, root, excluded_dirs):
+        for directory, subdirs, _ in os.walk(root):
+            subdirs[:] = [name for name in subdirs if name not in excluded_dirs]
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+            if wd < 0:
+                # Usually fs.inotify.max_user_watches is too low for the tree
+                raise OSError(ctypes.get_errno(), f"Could not watch {directory}")
+            self.paths[wd] = directory
+
+    def read(self, timeout):
+        """Returns a list of (path, mask) events, waiting up to 'timeout' seconds for the first one."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            buffer = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, name_length = _EVENT_HEADER.unpack_from(buffer, offset)
+            offset += _EVENT_HEADER.size
+            name = buffer[offset:offset + name_length].rstrip(b'\0')
+            offset += name_length
+            if mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+                continue
+            directory = self.paths.get(wd)
+            if directory is not None or mask & IN_Q_OVERFLOW:
+                events.append((os.path.join(directory, os.fsdecode(name)) if directory else None, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _directory_mtime(directory):
+    try:
+        return os.stat(directory).st_mtime
+    except OSError:
+        return None
+
+
+def _is_locked(path):
+    """On Windows a file still open for writing by the acquisition software cannot be opened for writing again."""
+    if sys.platform != 'win32':
+        return False
+    try:
+        fd = os.open(path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+    except PermissionError:
+        return True
+    except OSError:
+        return False
+    os.close(fd)
+    return False
+
+
+class FolderWatcher:
+    """
+    Finds TIFF files under 'root' as they are written, for a long-running compression service.
+    On local disks the tree is watched with inotify. On network shares (or if inotify is not available) every
+    directory is stat'ed every 'poll_interval' seconds and only those whose modification time changed are listed
+    again, so an idle watcher costs one stat per directory and interval instead of one per file. Polling only
+    notices files that are created, renamed or moved into the tree, not files rewritten in place.
+    A file is only yielded once it is finished: its size and modification time have not changed for 'settle_sec'
+    seconds, measured with the local clock so a share with a skewed clock does not matter, and, on Windows,
+    no other program holds it open for writing.
+    Files already in the tree are yielded first, those last modified more than 'settle_sec' ago right away.
+    Stops when 'stop_event', shared by everything stopped by Ctrl+C, or 'cancel_event', set when the pipeline the files
+    go to is cancelled, is set.
+    """
+
+    def __init__(self, root, excluded_dirs=(), poll_interval=DEFAULT_POLL_INTERVAL_SEC, settle_sec=DEFAULT_SETTLE_SEC,
+                 use_inotify=True, stop_event=None, cancel_event=None):
+        self.root = root
+        self.excluded_dirs = set(excluded_dirs)
+        self.poll_interval = poll_interval
+        self.settle_sec = settle_sec
+        self.stop_events = [event for event in (stop_event, cancel_event) if event is not None]
+        # Last (size, mtime) of every file yielded, and (size, mtime, unchanged since) of the files waiting to settle
+        self.known = {}
+        self.candidates = {}
+        # Modification time of every directory when it was last listed, and the directories changed at the last poll
+        self.dir_mtimes = {}
+        self.recently_changed = set()
+        self.inotify = None
+        if use_inotify and sys.platform.startswith('linux'):
+            try:
+                self.inotify = _Inotify()
+                self.inotify.add_tree(root, self.excluded_dirs)
+            except OSError as e:
+                logging.warning(f"Watching {root} with inotify failed, polling instead: {e}")
+                if self.inotify is not None:
+                    self.inotify.close()
+                self.inotify = None
+
+    def _stopped(self):
+        return any(event.is_set() for event in self.stop_events)
+
+    def _scan(self, directory, trust_mtime=False):
+        """
+        Crawls a directory, making every new or changed file a candidate.
+        With 'trust_mtime' files last modified more than 'settle_sec' ago are yielded without waiting.
+        """
+        now = time.time()
+        dir_mtimes = self.dir_mtimes if self.inotify is None else None
+        for path, size, mtime in scan_tiff_files(directory, excluded_dirs=self.excluded_dirs, dir_mtimes=dir_mtimes):
+            if self.known.get(path) == (size, mtime):
+                continue
+            if trust_mtime and now - mtime >= self.settle_sec and not _is_locked(path):
+                self.known[path] = (size, mtime)
+                yield path, size, mtime
+            elif self.candidates.get(path, (None, None))[:2] != (size, mtime):
+                self.candidates[path] = (size, mtime, time.monotonic())
+
+    def _forget_directory(self, directory):
+        prefix = directory + os.sep
+        for known_dir in [d for d in self.dir_mtimes if d == directory or d.startswith(prefix)]:
+            del self.dir_mtimes[known_dir]
+
+    def _list_directory(self, directory):
+        """
+        Lists one directory again, making the files not seen before candidates and crawling new subdirectories.
+        Files already known are not stat'ed.
+        """
+        try:
+            # Taken before the listing, so a change during the listing shows at the next poll
+            mtime = os.stat(directory).st_mtime
+            with os.scandir(directory) as entries:
+                entries = list(entries)
+        except OSError:
+            # Deleted or renamed, its new name shows up in the listing of its parent
+            self._forget_directory(directory)
+            return
+        self.dir_mtimes[directory] = mtime
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in self.excluded_dirs and entry.path not in self.dir_mtimes:
+                        yield from self._scan(entry.path)
+                elif entry.name.endswith(TIFF_EXTENSIONS) and entry.path not in self.known \
+                        and entry.path not in self.candidates and entry.is_file():
+                    stat = entry.stat()
+                    self.candidates[entry.path] = (stat.st_size, stat.st_mtime, time.monotonic())
+            except OSError:
+                continue
+
+    def _poll(self):
+        """
+        Lists again the directories whose modification time changed since they were last listed.
+        Those changed at the previous poll are listed once more, in case they changed again within the resolution
+        of the modification time, which is 1 or 2 seconds on some shares.
+        """
+        if self.root not in self.dir_mtimes:
+            # First poll, or inotify failed after the initial crawl
+            yield from self._scan(self.root)
+            return
+        directories = list(self.dir_mtimes)
+        with ThreadPoolExecutor(max_workers=CRAWLER_THREADS) as pool:
+            mtimes = list(pool.map(_directory_mtime, directories))
+        changed = {directory for directory, mtime in zip(directories, mtimes) if mtime != self.dir_mtimes[directory]}
+        # Parents first, so a renamed directory is forgotten before its new name is crawled
+        for directory in sorted(changed | self.recently_changed):
+            yield from self._list_directory(directory)
+        self.recently_changed = changed
+
+    def _settled(self):
+        """Yields the candidates that have not changed for 'settle_sec' seconds."""
+        now = time.monotonic()
+        for path, (size, mtime, since) in list(self.candidates.items()):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # Deleted or renamed before it settled
+                del self.candidates[path]
+                continue
+            current = (stat.st_size, stat.st_mtime)
+            if current != (size, mtime):
+                self.candidates[path] = (*current, now)
+            elif now - since >= self.settle_sec and not _is_locked(path):
+                del self.candidates[path]
+                self.known[path] = current
+                yield (path, *current)
+
+    def _handle_events(self, events):
+        for path, mask in events:
+            if mask & IN_Q_OVERFLOW:
+                logging.warning(f"inotify queue of {self.root} overflowed, crawling the folder again")
+                yield from self._scan(self.root)
+            elif mask & IN_ISDIR:
+                if os.path.basename(path) not in self.excluded_dirs:
+                    try:
+                        self.inotify.add_tree(path, self.excluded_dirs)
+                    except OSError as e:
+                        logging.warning(f"Watching {path} with inotify failed, polling {self.root} instead: {e}")
+                        self.inotify.close()
+                        self.inotify = None
+                    # Files created before the watch was in place do not produce events
+                    yield from self._scan(path)
+                    if self.inotify is None:
+                        return
+            elif path.endswith(TIFF_EXTENSIONS) and not mask & IN_CREATE:
+                self.candidates[path] = (None, None, time.monotonic())
+
+    def watch(self):
+        """Yields (path, size, mtime) for every finished file, until a stop event is set."""
+        try:
+            yield from self._scan(self.root, trust_mtime=True)
+            next_poll = time.monotonic() + self.poll_interval
+            while not self._stopped():
+                yield from self._settled()
+                # Without candidates nothing needs to be checked until the next event, poll or stop request
+                wait = STOP_CHECK_INTERVAL_SEC if self.candidates or self.stop_events else None
+                if self.inotify is not None:
+                    yield from self._handle_events(self.inotify.read(wait))
+                elif time.monotonic() >= next_poll:
+                    yield from self._poll()
+                    next_poll = time.monotonic() + self.poll_interval
+                else:
+                    self._wait(min(wait or self.poll_interval, next_poll - time.monotonic()))
+        finally:
+            if self.inotify is not None:
+                self.inotify.close()
+
+    def _wait(self, seconds):
+        if not self.stop_events:
+            time.sleep(max(0, seconds))
+            return
+        deadline = time.monotonic() + seconds
+        while not self._stopped() and deadline > time.monotonic():
+            # Ctrl+C wakes the wait right away, a cancelled pipeline is noticed within a stop check interval
+            self.stop_events[0].wait(min(STOP_CHECK_INTERVAL_SEC, deadline - time.monotonic()))
@@ -3,169 +3,871 @@ import os
 import argparse
 import shutil
 import time
+import sys
 import uuid
-import pkg_resources
 import tifffile
 from tqdm import tqdm
 import threading
-import queue
 import logging
-from gooey import Gooey
+import multiprocessing
+import signal
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from compression_manifest import (
+    DONE_STATUSES, MANIFEST_FILE, RECORD_FIELDS, STATUS_ALREADY_COMPRESSED, STATUS_BELOW_THRESHOLD, STATUS_COMPRESSED,
+    STATUS_ERROR, STATUS_ESTIMATED_BELOW_THRESHOLD, STATUS_NOT_AN_IMAGE, STATUS_VERIFICATION_FAILED, CompressionManifest,
+    read_done_files, relative_key, worker_manifest_path)
+from directory_crawler import scan_tiff_files
+from folder_watcher import DEFAULT_POLL_INTERVAL_SEC, DEFAULT_SETTLE_SEC, FolderWatcher
+import file_transfer
+from pipeline import Channel, Pipeline, PipelineCancelled
+from pipeline_metrics import ByteProgress, MetricsSink
+from work_leases import DEFAULT_LEASE_TTL_SEC, LEASE_DIR, LEASE_HEARTBEAT_SEC, WorkLeases, read_done_records
+from tiff_streaming import (
+    DEFAULT_MEMORY_BUDGET_MB, LEVEL_COMPRESSIONS, OUTPUT_FORMATS, PYRAMID_LEVELS_SIZE_FRACTION, benchmark_codecs,
+    estimate_compression_ratio, get_write_kwargs, hash_tiff_pixels, read_tiff_header, stream_recompress)
 
-MAX_FILES_IN_CACHE = 3
+MAX_FILES_IN_CACHE = 64
+CACHE_BUDGET_FREE_SPACE_FRACTION = 0.5
+CACHE_FREE_SPACE_MARGIN_BYTES = 1024 ** 3
+CACHE_BUDGET_RECHECK_SEC = 5
+DEFAULT_UPLOAD_WORKERS = 2
 COMPRESSION_RATIO_THRESHOLD = 1.5
-PROCESSING_THEAD_TIMEOUT_SEC = 1200
+# Files are skipped before caching if their estimated ratio is below the threshold times this margin
+RATIO_ESTIMATE_MARGIN = 0.9
+RATIO_ESTIMATE_MIN_FILE_MB = 64
 REMOTE_DISCONNECTING_TIMEOUT_SEC = 600
+REMOTE_RECHECK_SEC = 1
 COMPRESSED_FILES_FILE = "_already_compressed_files"
 COMPRESSED_FOLDER = "_compressed_files"
+# Headers are read by several threads at once, to hide the latency of network shares
+TRIAGE_THREADS = 16
+# Files waiting for their header to be read, so a crawl of a huge share does not queue every read at once
+TRIAGE_MAX_PENDING = 4 * TRIAGE_THREADS
+TRIAGE_RECOMPRESS = "recompress"
+TRIAGE_CONVERT = "convert"
+TRIAGE_SKIP = "skip"
+# Compression tags written for each --compression choice
+TARGET_COMPRESSION_TAGS = {
+    'zlib': tifffile.COMPRESSION.ADOBE_DEFLATE,
+    'lzw': tifffile.COMPRESSION.LZW,
+    'jpeg_2000_lossy': tifffile.COMPRESSION.JPEG2000,
+    'zstd': tifffile.COMPRESSION.ZSTD,
+}
+# Codecs so weak that files stored with them are always worth converting
+WEAK_COMPRESSIONS = (tifffile.COMPRESSION.PACKBITS, tifffile.COMPRESSION.CCITTRLE)
+# Lossless (compression, level, predictor) settings tried by --auto, a level of None is the default of the codec
+AUTO_CODEC_CANDIDATES = [
+    ('zstd', 1, False), ('zstd', 1, True), ('zstd', 3, True), ('zstd', 9, True), ('zstd', 15, True),
+    ('zlib', 1, True), ('zlib', 6, False), ('zlib', 6, True),
+    ('lzw', None, False), ('lzw', None, True),
+]
+AUTO_SAMPLE_FILES = 4
+AUTO_DEFAULT_MIN_SPEED_MB_S = 100
+# Order in which the files found so far are copied: as found, by size, or alternately the largest and the smallest
+SCHEDULING_POLICIES = ('found', 'largest_first', 'smallest_first', 'interleaved')
 
 
 def logging_broadcast(string):
     print(string)
     logging.info(string)
 
-def copy_files_to_cache(remote_files, cache_dir, cache_queue, semaphore):
-    for remote_file_path in remote_files:
-        cache_file_path = os.path.join(cache_dir, os.path.basename(remote_file_path))
-        if os.path.basename(remote_file_path) in os.listdir(cache_dir):
-            cache_file_path += "_" + uuid.uuid4().hex
+def record_processed_file(manifest, remote_file_path, status, file_record, metrics=None, leases=None, **fields):
+    """
+    Records the outcome for a file in the manifest, with the size and modification time it has now,
+    and passes its stage timings on to the metrics sink.
+    With 'leases' the record is also stored next to the lease of the file before it is released, for the other workers.
+    """
+    try:
+        stat = os.stat(remote_file_path)
+        size, mtime = stat.st_size, stat.st_mtime
+    except OSError:
+        size = mtime = None
+    file_record = {**file_record, **fields}
+    record_fields = {name: value for name, value in file_record.items() if name in RECORD_FIELDS}
+    manifest.record(remote_file_path, status, **{**record_fields, 'size': size, 'mtime': mtime})
+    if metrics is not None:
+        metrics.file_done(remote_file_path, status, file_record)
+    if leases is not None:
+        leases.record_done(remote_file_path, {**record_fields, 'status': status, 'size': size, 'mtime': mtime})
+        leases.release(remote_file_path)
+
+
+def _claim_file(file_path, leases, is_done):
+    """Returns 'claimed' if this worker got the lease of the file, 'done' if it was processed by now, else 'busy'."""
+    if not leases.acquire(file_path):
+        return "busy"
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        # The copy stage waits for a disconnected share
+        return "claimed"
+    if is_done(file_path, stat.st_size, stat.st_mtime):
+        leases.release(file_path)
+        return "done"
+    return "claimed"
+
+
+def _claim_deferred(deferred, leases, is_done, progress):
+    """Tries the files leased by other workers again, yielding the claimed ones and keeping the busy ones in 'deferred'."""
+    busy = []
+    for file_item in deferred:
+        claim = _claim_file(file_item[0], leases, is_done)
+        if claim == "claimed":
+            yield file_item
+        elif claim == "done":
+            progress.skip(file_item[0])
+        else:
+            busy.append(file_item)
+    deferred[:] = busy
+
+
+def claim_files(file_items, leases, is_done, progress, cancel_event, retry_interval=LEASE_HEARTBEAT_SEC,
+                before_wait=None, wait_for_others=True):
+    """
+    Yields the (path, size) items of the files this worker holds the lease of, skipping the ones other workers
+    processed in the meantime. Files leased by other workers are tried again every 'retry_interval' seconds, until
+    they are done or their lease expired because the worker holding it crashed. 'file_items' may yield None when
+    no file came for a while (see Channel.iterate), so retries also happen while a watched folder is quiet.
+    Once 'file_items' ends, the files still leased by others are waited for, unless 'wait_for_others' is False.
+    'before_wait' is called before waiting for the other workers, to finish the files already claimed.
+    """
+    deferred = []
+    next_retry = time.monotonic() + retry_interval
+    for file_item in file_items:
+        if file_item is not None:
+            claim = _claim_file(file_item[0], leases, is_done)
+            if claim == "claimed":
+                yield file_item
+            elif claim == "done":
+                progress.skip(file_item[0])
+            else:
+                deferred.append(file_item)
+        if time.monotonic() >= next_retry:
+            yield from _claim_deferred(deferred, leases, is_done, progress)
+            next_retry = time.monotonic() + retry_interval
+    while deferred and wait_for_others:
+        if before_wait is not None:
+            before_wait()
+        logging_broadcast(f"Waiting for other workers to finish {len(deferred)} files")
+        if cancel_event.wait(retry_interval):
+            raise PipelineCancelled("Waiting for other workers was cancelled")
+        yield from _claim_deferred(deferred, leases, is_done, progress)
+    for file_item in deferred:
+        # Left to the workers holding them, or to the next run if they crash
+        progress.skip(file_item[0])
 
-        # Acquire the semaphore before adding the local file path to the cache queue
-        semaphore.acquire()
 
-        remote_disconnect_timeout_sec = REMOTE_DISCONNECTING_TIMEOUT_SEC
-        while remote_disconnect_timeout_sec > 0 and not os.path.exists(remote_file_path):
-            time.sleep(1)
-            if remote_disconnect_timeout_sec % 10 == 0: logging_broadcast(f"Remote file path still does not exist, looks like remote location disconnected!")
-            remote_disconnect_timeout_sec -= 1
-        if remote_disconnect_timeout_sec < 0:
-            logging_broadcast("FATAL ERROR: Reached timeout while waiting for remote share to reconnect.")
-            exit(1) 
+def get_codec_name(compression, quality, level=None, predictor=False):
+    if compression == "jpeg_2000_lossy":
+        return f"{compression}:{quality}"
+    name = compression if level is None or compression not in LEVEL_COMPRESSIONS else f"{compression}:{level}"
+    return name + "+predictor" if predictor else name
 
+
+def is_estimated_incompressible(remote_file_path, file_size, write_kwargs):
+    """
+    Trial-compresses a few pages read directly from the remote file.
+    Returns True if the file is predicted to end up below COMPRESSION_RATIO_THRESHOLD, so it is not worth caching.
+    """
+    if file_size < RATIO_ESTIMATE_MIN_FILE_MB * 1024 * 1024:
+        return False
+    try:
+        estimated_ratio = estimate_compression_ratio(remote_file_path, write_kwargs)
+    except Exception as e:
+        logging_broadcast(f"Could not estimate the compression ratio of {remote_file_path}: {e}")
+        return False
+    if estimated_ratio is None or estimated_ratio >= COMPRESSION_RATIO_THRESHOLD * RATIO_ESTIMATE_MARGIN:
+        return False
+    logging_broadcast(f"Estimated compression ratio {round(estimated_ratio, 2)}x is below "
+                      f"{COMPRESSION_RATIO_THRESHOLD}, skipping file {remote_file_path}")
+    return True
+
+
+def classify_tiff(header, compression, recompress_compressed=False):
+    """
+    Decides from the TIFF header alone what to do with a file.
+    Uncompressed files are recompressed, files stored with a weak codec are converted, files that are already
+    compressed (or with 'recompress_compressed' already use the target codec) and files without images are skipped.
+    Returns the decision and the manifest status of skipped files.
+    """
+    if not header['is_image']:
+        return TRIAGE_SKIP, STATUS_NOT_AN_IMAGE
+    if header['compression'] == tifffile.COMPRESSION.NONE:
+        return TRIAGE_RECOMPRESS, None
+    if header['compression'] in WEAK_COMPRESSIONS:
+        return TRIAGE_CONVERT, None
+    if recompress_compressed and header['compression'] != TARGET_COMPRESSION_TAGS.get(compression):
+        return TRIAGE_CONVERT, None
+    return TRIAGE_SKIP, STATUS_ALREADY_COMPRESSED
+
+
+def triage_file(file_path, size, mtime, cached_headers, manifest, compression, recompress_compressed=False,
+                metrics=None, is_done=None):
+    """
+    Returns True if the file should be processed, reading its TIFF header unless it is cached in the manifest
+    for the same size and modification time. Skipped files are recorded in the manifest.
+    'is_done' keeps the record of a file another process compressed since it was found.
+    """
+    cached = cached_headers.get(manifest.key(file_path))
+    if cached is not None and cached[:2] == (size, mtime):
+        header = cached[2]
+    else:
         try:
-            # Download the file from the remote location to the local cache folder
-            shutil.copy2(remote_file_path, cache_file_path)
-            # Add the local file path to the cache queue
-            cache_queue.put((cache_file_path, remote_file_path))
-            logging_broadcast(f"Cached file: {cache_file_path}")
+            header = read_tiff_header(file_path)
+        except OSError as e:
+            # Leave the file to the copy stage, which waits for a disconnected remote share
+            logging.warning(f"Could not read the TIFF header of {file_path}: {e}")
+            return True
+        manifest.record_header(file_path, size, mtime, header)
+    decision, status = classify_tiff(header, compression, recompress_compressed)
+    if header['compression'] is None:
+        message = "no image data"
+    elif header['compression'] in tifffile.COMPRESSION._value2member_map_:
+        message = f"stored with {tifffile.COMPRESSION(header['compression']).name}"
+    else:
+        message = f"stored with compression {header['compression']}"
+    logging.info(f"Triage: {decision} {file_path}, {message}")
+    if decision != TRIAGE_SKIP:
+        return True
+    if is_done is not None:
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return False
+        if is_done(file_path, stat.st_size, stat.st_mtime):
+            return False
+    record_processed_file(manifest, file_path, status, {}, metrics, message=message)
+    return False
+
+
+def split_cpu_cores(workers, threads):
+    """
+    Returns the number of codec threads per file, so that 'workers' files compressed at once share the CPU cores.
+    An explicitly set number of threads is kept.
+    """
+    if threads is not None or workers <= 1:
+        return threads
+    return max(1, (os.cpu_count() or 1) // workers)
+
+
+class CacheBudget:
+    """
+    Limits the local cache by bytes instead of by number of files.
+    Every cached file reserves its own size plus the same again for the '.part' output written beside it, and with
+    a pyramid 'output_format' also room for the subresolution levels.
+    A file is admitted while the reservations fit into 'budget_bytes' and the cache disk keeps a free space margin,
+    so many small files can be prefetched while a few big ones never fill the disk.
+    """
+
+    def __init__(self, cache_dir, budget_bytes=None, max_files=MAX_FILES_IN_CACHE, output_format='tiff'):
+        self.cache_dir = cache_dir
+        self.levels_fraction = PYRAMID_LEVELS_SIZE_FRACTION if output_format.endswith('pyramid') else 0
+        if budget_bytes is None:
+            budget_bytes = int(shutil.disk_usage(cache_dir).free * CACHE_BUDGET_FREE_SPACE_FRACTION)
+        self.budget_bytes = budget_bytes
+        self.max_files = max_files
+        self.reserved = {}
+        self.cancelled = False
+        self.condition = threading.Condition()
+
+    def reservation_size(self, file_size, direct=False):
+        # The levels of a pyramid are buffered in temporary files in the cache and then added to the output,
+        # estimated from the size of the input
+        levels_size = int(file_size * self.levels_fraction)
+        if direct:
+            # The input is read in place and the output written beside it, only the level buffers are in the cache
+            return levels_size
+        # The cached input and its compressed '.part' output, which can be as big as the input for noisy data
+        return 2 * file_size + 2 * levels_size
+
+    def _fits(self, nbytes):
+        if len(self.reserved) >= self.max_files:
+            return False
+        reserved_bytes = sum(self.reserved.values())
+        free_bytes = shutil.disk_usage(self.cache_dir).free
+        if free_bytes - reserved_bytes - nbytes < CACHE_FREE_SPACE_MARGIN_BYTES:
+            return False
+        # A file bigger than the whole budget is still admitted alone, as long as it fits on the disk
+        return not self.reserved or reserved_bytes + nbytes <= self.budget_bytes
+
+    def fits(self, file_size):
+        """Returns True if a file of 'file_size' bytes fits into the cache right now."""
+        with self.condition:
+            return self._fits(self.reservation_size(file_size))
+
+    def is_reserved(self, key):
+        with self.condition:
+            return key in self.reserved
+
+    def acquire(self, key, file_size, direct=False):
+        """
+        Blocks until a file of 'file_size' bytes fits into the cache, with 'direct' a file compressed in place.
+        Returns False if the file can never fit, because it does not fit on the cache disk even with an empty cache.
+        Raises PipelineCancelled if the budget is cancelled while waiting.
+        """
+        nbytes = self.reservation_size(file_size, direct)
+        with self.condition:
+            while not self._fits(nbytes):
+                if self.cancelled:
+                    raise PipelineCancelled("Waiting for cache space was cancelled")
+                if not self.reserved:
+                    return False
+                # Free space can also change outside of this program, so recheck periodically
+                self.condition.wait(timeout=CACHE_BUDGET_RECHECK_SEC)
+            self.reserved[key] = nbytes
+            return True
+
+    def release(self, key):
+        with self.condition:
+            self.reserved.pop(key, None)
+            self.condition.notify_all()
+
+    def cancel(self):
+        with self.condition:
+            self.cancelled = True
+            self.condition.notify_all()
+
+
+def _triage_and_queue(file_path, size, mtime, file_queue, progress, triage_kwargs):
+    if file_queue.cancelled:
+        return
+    try:
+        process = triage_file(file_path, size, mtime, **triage_kwargs)
+    except Exception as e:
+        logging_broadcast(f"ERROR: Triage of {file_path} failed, processing it anyway. {e}")
+        process = True
+    if process:
+        progress.add(file_path, size)
+        file_queue.put((file_path, size))
+
+
+class CodecSelector:
+    """
+    Picks the codec settings, a (compression, level, predictor) tuple, for each file.
+    Without a target every file gets the settings given on the command line. With 'auto_target' the candidates in
+    AUTO_CODEC_CANDIDATES are trial-compressed on pages sampled from a few files of the directory of the file,
+    and the choice is cached per directory in the manifest, so the sampling is paid once per acquisition.
+    The target is the highest ratio encoding at least 'min_speed_mb_per_sec', or with 'min_ratio'
+    the fastest candidate reaching that ratio.
+    """
+
+    def __init__(self, compression, quality, threads, level=None, predictor=False, manifest=None,
+                 auto_target=False, min_speed_mb_per_sec=AUTO_DEFAULT_MIN_SPEED_MB_S, min_ratio=None):
+        self.default_settings = (compression, level, predictor)
+        self.quality = quality
+        self.threads = threads
+        self.manifest = manifest
+        self.auto_target = auto_target and manifest is not None
+        self.min_speed_mb_per_sec = min_speed_mb_per_sec
+        self.min_ratio = min_ratio
+        if min_ratio is not None:
+            self.target = f"fastest with ratio >= {min_ratio}"
+        else:
+            self.target = f"highest ratio at >= {min_speed_mb_per_sec} MB/s"
+        self.choices = manifest.codec_choices(self.target) if self.auto_target else {}
+        # The same few settings are used for every file, so their write arguments are only put together once
+        self.write_kwargs_cache = {}
+        self.lock = threading.Lock()
+
+    def write_kwargs(self, codec_settings):
+        if codec_settings not in self.write_kwargs_cache:
+            compression, level, predictor = codec_settings
+            self.write_kwargs_cache[codec_settings] = get_write_kwargs(
+                compression, self.quality, self.threads, level, predictor)
+        return self.write_kwargs_cache[codec_settings]
+
+    def codec_name(self, codec_settings):
+        compression, level, predictor = codec_settings
+        return get_codec_name(compression, self.quality, level, predictor)
+
+    def settings(self, file_path):
+        if not self.auto_target:
+            return self.default_settings
+        directory = os.path.dirname(file_path)
+        key = self.manifest.key(directory)
+        with self.lock:
+            if key not in self.choices:
+                self.choices[key] = self._benchmark_directory(directory)
+            return self.choices[key]
+
+    def _pick(self, results):
+        """Returns the index of the candidate meeting the target, or the closest one if none does."""
+        indices = range(len(results))
+        if self.min_ratio is not None:
+            eligible = [i for i in indices if results[i][0] >= self.min_ratio]
+            if not eligible:
+                return max(indices, key=lambda i: results[i][0])
+            return max(eligible, key=lambda i: results[i][1])
+        eligible = [i for i in indices if results[i][1] >= self.min_speed_mb_per_sec]
+        if not eligible:
+            return max(indices, key=lambda i: results[i][1])
+        return max(eligible, key=lambda i: results[i][0])
+
+    def _benchmark_directory(self, directory):
+        try:
+            file_paths = sorted(entry.path for entry in os.scandir(directory)
+                                if entry.name.lower().endswith(('.tif', '.tiff')) and entry.is_file())
+            if len(file_paths) > AUTO_SAMPLE_FILES:
+                file_paths = [file_paths[round(i * (len(file_paths) - 1) / (AUTO_SAMPLE_FILES - 1))]
+                              for i in range(AUTO_SAMPLE_FILES)]
+            results = benchmark_codecs(file_paths, [self.write_kwargs(settings) for settings in AUTO_CODEC_CANDIDATES])
         except Exception as e:
+            logging_broadcast(f"Could not benchmark codecs for {directory}, using {self.codec_name(self.default_settings)}: {e}")
+            return self.default_settings
+        if results is None:
+            return self.default_settings
+        for settings, (ratio, mb_per_sec) in zip(AUTO_CODEC_CANDIDATES, results):
+            logging.info(f"Codec {self.codec_name(settings)} on {directory}: {round(ratio, 2)}x, {round(mb_per_sec, 1)} MB/s")
+        best = self._pick(results)
+        settings = AUTO_CODEC_CANDIDATES[best]
+        ratio, mb_per_sec = results[best]
+        logging_broadcast(f"Picked codec {self.codec_name(settings)} for {directory} ({self.target}): "
+                          f"{round(ratio, 2)}x at {round(mb_per_sec, 1)} MB/s")
+        self.manifest.record_codec_choice(directory, self.target, settings, ratio, mb_per_sec)
+        return settings
+
+
+def discover_files(input_path, done_files, file_queue: Channel, progress, triage_kwargs=None, found_files=None,
+                   is_done=None):
+    """
+    Puts (path, size) of new or changed TIFF files on 'file_queue' while the folder is still being crawled,
+    adding them to the progress as they are found.
+    With 'triage_kwargs' (the arguments of triage_file) the headers of the files are read in parallel first,
+    and only files worth compressing are queued.
+    'found_files' replaces the crawl with another source of (path, size, mtime), like a FolderWatcher.
+    'is_done' checks files against the manifest as it is now, for files that were found again after they were processed.
+    """
+    if found_files is None:
+        found_files = scan_tiff_files(input_path, excluded_dirs=(COMPRESSED_FOLDER, LEASE_DIR))
+    triage_pool = ThreadPoolExecutor(max_workers=TRIAGE_THREADS if triage_kwargs is not None else 1)
+    pending = threading.BoundedSemaphore(TRIAGE_MAX_PENDING)
+    try:
+        for file_path, size, mtime in found_files:
+            if file_queue.cancelled:
+                raise PipelineCancelled("Discovery was cancelled")
+            if (CompressionManifest.is_unchanged(done_files.get(relative_key(input_path, file_path)), size, mtime)
+                    or (is_done is not None and is_done(file_path, size, mtime))):
+                continue
+            if triage_kwargs is not None:
+                while not pending.acquire(timeout=REMOTE_RECHECK_SEC):
+                    if file_queue.cancelled:
+                        raise PipelineCancelled("Discovery was cancelled")
+                future = triage_pool.submit(
+                    _triage_and_queue, file_path, size, mtime, file_queue, progress, triage_kwargs)
+                future.add_done_callback(lambda _: pending.release())
+            else:
+                progress.add(file_path, size)
+                file_queue.put((file_path, size))
+    except BaseException:
+        # Drop the header reads that did not start yet, instead of reading them all from the share first
+        triage_pool.shutdown(cancel_futures=True)
+        raise
+    triage_pool.shutdown()
+
+
+def wait_for_remote(remote_file_path, cancel_event, timeout=REMOTE_DISCONNECTING_TIMEOUT_SEC):
+    """
+    Returns right away if the file exists, otherwise waits for the remote share to reconnect.
+    Raises TimeoutError if it does not within 'timeout' seconds, and PipelineCancelled if 'cancel_event' is set.
+    """
+    deadline = time.monotonic() + timeout
+    next_message = 0
+    while not os.path.exists(remote_file_path):
+        now = time.monotonic()
+        if now > deadline:
+            raise TimeoutError("Reached timeout while waiting for remote share to reconnect.")
+        if now >= next_message:
+            logging_broadcast(f"Remote file path still does not exist, looks like remote location disconnected!")
+            next_message = now + 10
+        if cancel_event.wait(REMOTE_RECHECK_SEC):
+            raise PipelineCancelled("Waiting for the remote share was cancelled")
+
+
+def cache_files(cache_items, cache_queue: Channel, cache_budget, progress, metrics=None, transfer_kwargs=None,
+                leases=None):
+    """
+    Copies (remote path, cache path, size, file record) items to the cache directory and queues them for compression.
+    Several items are copied at the same time, see file_transfer.copy_files.
+    """
+    copy_start = time.perf_counter()
+    errors = file_transfer.copy_files([(remote_file_path, cache_file_path)
+                                       for remote_file_path, cache_file_path, _, _ in cache_items],
+                                      **(transfer_kwargs or {}))
+    # Files copied at the same time share the time of the copy, so the copy stage is not counted busy several times
+    copy_sec = (time.perf_counter() - copy_start) / len(cache_items)
+    for index, ((remote_file_path, cache_file_path, file_size, file_record), error) in enumerate(
+            zip(cache_items, errors)):
+        if error is not None:
+            logging_broadcast(f"ERROR: Failed to cache the file. {error}")
+            if os.path.exists(cache_file_path):
+                os.remove(cache_file_path)
+            cache_budget.release(cache_file_path)
+            progress.done(remote_file_path)
+            if leases is not None:
+                leases.release(remote_file_path)
+            continue
+        file_record.update(copy_sec=copy_sec, copy_bytes=file_size)
+        try:
+            # Add the local file path to the cache queue
+            cache_queue.put((cache_file_path, remote_file_path, file_record))
+        except PipelineCancelled:
+            for _, left_cache_file_path, _, _ in cache_items[index:]:
+                if os.path.exists(left_cache_file_path):
+                    os.remove(left_cache_file_path)
+            raise
+        if metrics is not None:
+            metrics.queue_depth(cache_queue.name, cache_queue.qsize())
+        logging_broadcast(f"Cached file: {cache_file_path}")
+
+
+def copy_files_to_cache(remote_files: Channel, cache_dir, cache_queue: Channel, cache_budget, codec_selector=None, manifest=None, progress=None, estimate_ratio=False, metrics=None,
+                        transfer_kwargs=None, direct=False, leases=None, is_done=None, wait_for_others=True):
+    """
+    Copies the files, given as (path, size) items, to the cache directory and queues them for compression.
+    Files too small to be split into transfer streams are copied as many at a time as there are streams, so small files
+    do not pay the latency of the share one after the other. A batch is copied once it is full, or before the stage
+    waits for more files.
+    With 'direct' the files are on a fast local disk and are queued to be compressed where they are, without a copy.
+    With 'estimate_ratio' large files predicted to compress badly with the codec picked by 'codec_selector' are skipped.
+    With 'leases' only files claimed by this worker are processed, see claim_files for 'wait_for_others'.
+    Fails with TimeoutError if the remote share stays disconnected for REMOTE_DISCONNECTING_TIMEOUT_SEC.
+    """
+    batch_size = (transfer_kwargs or {}).get('streams', file_transfer.DEFAULT_TRANSFER_STREAMS)
+    batch = []
+
+    def copy_batch():
+        if batch:
+            cache_files(list(batch), cache_queue, cache_budget, progress, metrics, transfer_kwargs, leases)
+            batch.clear()
+
+    if leases is not None:
+        # Files leased by other workers are tried again as often as the leases are renewed
+        remote_files = claim_files(
+            remote_files.iterate(on_idle=copy_batch, idle_timeout=leases.heartbeat_interval), leases, is_done, progress,
+            cache_queue.pipeline.cancel_event, leases.heartbeat_interval, copy_batch, wait_for_others)
+    else:
+        remote_files = remote_files.iterate(on_idle=copy_batch)
+    for remote_file_path, _ in remote_files:
+        cache_file_path = os.path.join(cache_dir, os.path.basename(remote_file_path))
+        # Files of this run with the same name are still reserved, files left by an earlier run are still there
+        if cache_budget.is_reserved(cache_file_path) or os.path.exists(cache_file_path):
+            cache_file_path += "_" + uuid.uuid4().hex
+
+        remote_wait_start = time.perf_counter()
+        wait_for_remote(remote_file_path, cache_queue.pipeline.cancel_event)
+        file_record = {'remote_wait_sec': time.perf_counter() - remote_wait_start}
+
+        # Reserve space for the file and its compressed output before adding the local file path to the cache queue
+        try:
+            file_size = os.path.getsize(remote_file_path)
+        except OSError as e:
             logging_broadcast(f"ERROR: Failed to cache the file. {e}")
+            progress.done(remote_file_path)
+            if leases is not None:
+                leases.release(remote_file_path)
+            continue
+        if estimate_ratio:
+            # In --auto mode this is also where the codec is picked for a directory the first time
+            codec_settings = codec_selector.settings(remote_file_path)
+            if is_estimated_incompressible(remote_file_path, file_size, codec_selector.write_kwargs(codec_settings)):
+                # Record the decision, so the file is skipped right away on the next run
+                record_processed_file(manifest, remote_file_path, STATUS_ESTIMATED_BELOW_THRESHOLD, file_record,
+                                      metrics, leases, codec=codec_selector.codec_name(codec_settings))
+                progress.skip(remote_file_path)
+                continue
+        if direct:
+            # Only the level buffers of a pyramid take space in the cache
+            if cache_budget.reservation_size(file_size, direct=True) \
+                    and not cache_budget.acquire(remote_file_path, file_size, direct=True):
+                logging_broadcast(f"ERROR: Not enough free space in {cache_dir} for the pyramid levels of {remote_file_path}, skipping.")
+                progress.done(remote_file_path)
+                if leases is not None:
+                    leases.release(remote_file_path)
+                continue
+            cache_queue.put((remote_file_path, remote_file_path, file_record))
+            continue
+        if batch and not cache_budget.fits(file_size):
+            # The files waiting in the batch may be what fills the cache, copy them before waiting for space
+            copy_batch()
+        cache_wait_start = time.perf_counter()
+        if not cache_budget.acquire(cache_file_path, file_size):
+            logging_broadcast(f"ERROR: Not enough free space in {cache_dir} to cache the file {remote_file_path}, skipping.")
+            progress.done(remote_file_path)
+            if leases is not None:
+                leases.release(remote_file_path)
+            continue
+        file_record['cache_wait_sec'] = time.perf_counter() - cache_wait_start
+
+        # Download the file from the remote location to the local cache folder
+        cache_item = (remote_file_path, cache_file_path, file_size, file_record)
+        if file_size >= file_transfer.PARALLEL_TRANSFER_MIN_BYTES:
+            cache_files([cache_item], cache_queue, cache_budget, progress, metrics, transfer_kwargs, leases)
+            continue
+        batch.append(cache_item)
+        if len(batch) >= batch_size:
+            copy_batch()
+    copy_batch()
 
 
 def compress_one_file(
-        remote_file_paths, pbar, cache_queue: queue.Queue, semaphore, done_paths_file, quality, compression, threads,
-        replace_files,):
-
-    processed_files = 0
-    timeout = PROCESSING_THEAD_TIMEOUT_SEC
-    while processed_files < len(remote_file_paths):
-        if cache_queue.empty():
-            time.sleep(1)
-            timeout -= 1
-            if timeout < 0:
-                logging_broadcast("FATAL ERROR: Processing thread reached a timeout!")
-                exit(1)
-            continue
-        timeout = PROCESSING_THEAD_TIMEOUT_SEC
-        
-        cached_file_path, remote_file_path = cache_queue.get()
+        progress, cache_queue: Channel, cache_budget, manifest, quality, compression, threads,
+        replace_files, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB, executor=None, upload_queue: Channel = None,
+        metrics=None, transfer_kwargs=None, codec_selector=None, output_format='tiff', leases=None, verify=False):
+    """
+    Compresses the cached files until the cache queue is closed, handing the results over to the upload queue.
+    Without an upload queue the results are uploaded right away.
+    With 'verify' the hash of the pixels of the original is computed while it is read, for verify_files.
+    """
+
+    if codec_selector is None:
+        codec_selector = CodecSelector(compression, quality, threads)
+
+    for cache_item in cache_queue:
+        if metrics is not None:
+            metrics.queue_depth(cache_queue.name, cache_queue.qsize())
+        cached_file_path, remote_file_path, file_record = cache_item
+        # Files on a local disk are compressed in place, reading the original directly
+        direct = cached_file_path == remote_file_path
+        codec_settings = codec_selector.settings(remote_file_path)
+        file_record['codec'] = codec_selector.codec_name(codec_settings)
         temp_cached_file_path = cached_file_path + '.part'
         remote_dir_with_file = os.path.dirname(remote_file_path)
         if not replace_files:
             compressed_dir = os.path.join(remote_dir_with_file, COMPRESSED_FOLDER)
-            os.makedirs(compressed_dir, exist_ok=True)
             temp_remote_file_path = os.path.join(compressed_dir, os.path.basename(remote_file_path))
         else:
             temp_remote_file_path = remote_file_path + '.part'
 
-        error_compressing = False
         try:
             original_file_size = os.path.getsize(cached_file_path)
             # Compress the TIFF file using the specified algorithm and quality
-            tifffile_version = pkg_resources.get_distribution("tifffile").version
-            with tifffile.TiffWriter(temp_cached_file_path) as tiff:
-                if tifffile_version > "2022.7.28":
-                    if compression == "jpeg_2000_lossy":
-                        tiff.write(tifffile.imread(cached_file_path), compression=compression, compressionargs={'level': quality}, maxworkers=threads)
-                    else:
-                        tiff.write(tifffile.imread(cached_file_path), compression=compression, maxworkers=threads)
-                else:
-                    tiff.write(tifffile.imread(cached_file_path), compression=(compression, quality), maxworkers=threads)
+            write_kwargs = codec_selector.write_kwargs(codec_settings)
+            # Stream the file page by page (or tile by tile) so memory use is bounded by the budget, not the file size
+            memory_budget_bytes = memory_budget_mb * 1024 * 1024
+            compress_start = time.perf_counter()
+            if executor is not None:
+                # Run the CPU heavy part in a worker process, so several files are compressed in parallel
+                timings = executor.submit(
+                    stream_recompress, cached_file_path, temp_cached_file_path, write_kwargs, memory_budget_bytes, direct,
+                    output_format, verify, cache_budget.cache_dir).result()
+            else:
+                timings = stream_recompress(
+                    cached_file_path, temp_cached_file_path, write_kwargs, memory_budget_bytes, direct, output_format,
+                    verify, cache_budget.cache_dir)
+            file_record.update(timings, compress_sec=time.perf_counter() - compress_start)
         except Exception as e:
             logging_broadcast(f"Error compressing: {remote_file_path}")
             logging_broadcast(e)
-            error_compressing = True          
+            record_processed_file(manifest, remote_file_path, STATUS_ERROR, file_record, metrics, leases, message=str(e))
             if os.path.exists(temp_cached_file_path):
                 os.remove(temp_cached_file_path)  
-            if os.path.exists(cached_file_path):
+            if not direct and os.path.exists(cached_file_path):
                 os.remove(cached_file_path)  
-            cache_queue.task_done()
-            pbar.update(1)
+            progress.done(remote_file_path)
             logging_broadcast("")
-            semaphore.release()
-            processed_files += 1
+            cache_budget.release(cached_file_path)
             continue
 
-        os.remove(cached_file_path)
+        if not direct:
+            os.remove(cached_file_path)
         
         compressed_file_size = os.path.getsize(temp_cached_file_path)
         compression_ratio =  float(original_file_size) / compressed_file_size
-
+        file_record.update(
+            original_size=original_file_size, compressed_size=compressed_file_size, ratio=compression_ratio)
 
         if compression_ratio > COMPRESSION_RATIO_THRESHOLD:
-            try:
-                # Move the compressed file from the temporary cache directory to the final destination
-                shutil.move(temp_cached_file_path, temp_remote_file_path)
-            except OSError as e:
-                # That is a workaround when shutil is raising an error when copying file to samba share where you can't copy permissions
-                if e.errno == 95:
-                    if os.path.isfile(temp_cached_file_path):
-                        os.remove(temp_cached_file_path)
-                else:
-                    logging_broadcast(f"Error compressing: {remote_file_path}\n" + str(e))
-                    error_compressing = True
-            if replace_files and error_compressing == False:
-                # Replace the original file with the compressed file
+            upload_item = (temp_cached_file_path, temp_remote_file_path, remote_file_path, cached_file_path,
+                           file_record)
+            if upload_queue is not None:
+                # Hand the result over to the upload threads and continue with the next cached file
                 try:
-                    shutil.move(temp_remote_file_path, remote_file_path)
-                except OSError as e:
-                    if e.errno == 95:
-                        pass
-                    else:
-                        logging_broadcast(f"Error compressing: {remote_file_path}\n" + str(e))
-                        error_compressing = True
-            logging_broadcast(f"Compressed: {remote_file_path}, compression ratio: {round(compression_ratio, 2)}x")
+                    upload_queue.put(upload_item)
+                except PipelineCancelled:
+                    os.remove(temp_cached_file_path)
+                    raise
+                if metrics is not None:
+                    metrics.queue_depth(upload_queue.name, upload_queue.qsize())
+            else:
+                upload_compressed_file(upload_item, progress, cache_budget, manifest, replace_files, metrics,
+                                       transfer_kwargs, leases)
         else:
             logging_broadcast(f"Compression ratio is below {COMPRESSION_RATIO_THRESHOLD}, skipping file {remote_file_path}")
             os.remove(temp_cached_file_path)
-        
-        if error_compressing == False:
-            with open(done_paths_file, 'a') as f:
-                f.write(remote_file_path + "\n")
-            
-        # Release the semaphore after the compressed file has been copied to the remote location
+            record_processed_file(manifest, remote_file_path, STATUS_BELOW_THRESHOLD, file_record, metrics, leases)
+            progress.done(remote_file_path)
+            logging_broadcast("")
+            cache_budget.release(cached_file_path)
 
-        # Mark the file task as done in the cache queue
-        cache_queue.task_done()
-        pbar.update(1)
-        logging_broadcast("")
-        semaphore.release()
-        processed_files += 1
+
+def verify_files(verify_queue: Channel, upload_queue: Channel, progress, cache_budget, manifest,
+                 memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB, executor=None, metrics=None, leases=None):
+    """
+    Decodes the compressed files page by page and compares the hash of their pixels with the hash of the originals,
+    passing the files that match on to the upload queue. Runs while the next files are compressed.
+    Files that do not match are recorded as failed and their originals are kept.
+    """
+    memory_budget_bytes = memory_budget_mb * 1024 * 1024
+    for upload_item in verify_queue:
+        if metrics is not None:
+            metrics.queue_depth(verify_queue.name, verify_queue.qsize())
+        temp_cached_file_path, _, remote_file_path, cached_file_path, file_record = upload_item
+        verify_start = time.perf_counter()
+        error_message = None
+        try:
+            if executor is not None:
+                compressed_pixel_hash = executor.submit(
+                    hash_tiff_pixels, temp_cached_file_path, memory_budget_bytes).result()
+            else:
+                compressed_pixel_hash = hash_tiff_pixels(temp_cached_file_path, memory_budget_bytes)
+        except Exception as e:
+            compressed_pixel_hash = None
+            error_message = f"Could not decode the compressed file: {e}"
+        file_record.update(compressed_pixel_hash=compressed_pixel_hash, verify_sec=time.perf_counter() - verify_start)
+        if compressed_pixel_hash is not None and compressed_pixel_hash == file_record.get('pixel_hash'):
+            try:
+                upload_queue.put(upload_item)
+            except PipelineCancelled:
+                os.remove(temp_cached_file_path)
+                raise
+            if metrics is not None:
+                metrics.queue_depth(upload_queue.name, upload_queue.qsize())
+            continue
+        if error_message is None:
+            error_message = "The pixels of the compressed file differ from the original"
+        logging_broadcast(f"ERROR: Verification of {remote_file_path} failed, keeping the original. {error_message}")
+        os.remove(temp_cached_file_path)
+        record_processed_file(manifest, remote_file_path, STATUS_VERIFICATION_FAILED, file_record, metrics, leases,
+                              message=error_message)
+        progress.done(remote_file_path)
+        cache_budget.release(cached_file_path)
 
 
-def compress_tiff_files(input_path, cache_dir, *args):
+def upload_compressed_file(upload_item, progress, cache_budget, manifest, replace_files, metrics=None,
+                           transfer_kwargs=None, leases=None, created_dirs=None):
+    """
+    Moves a compressed file to the remote location and records the result.
+    'created_dirs' is a set of the COMPRESSED_FOLDER folders created so far, so every folder is created only once.
+    """
+    temp_cached_file_path, temp_remote_file_path, remote_file_path, cached_file_path, file_record = upload_item
+    if leases is not None and not leases.is_held(remote_file_path):
+        # The lease expired and another worker took the file over, leave the file to it
+        logging_broadcast(f"ERROR: Lost the lease of {remote_file_path}, discarding the compressed file.")
+        os.remove(temp_cached_file_path)
+        progress.skip(remote_file_path)
+        cache_budget.release(cached_file_path)
+        return
+    upload_start = time.perf_counter()
+    remote_dir_with_file = os.path.dirname(remote_file_path)
+    compressed_dir = os.path.join(remote_dir_with_file, COMPRESSED_FOLDER)
+    if not replace_files and (created_dirs is None or compressed_dir not in created_dirs):
+        os.makedirs(compressed_dir, exist_ok=True)
+        if created_dirs is not None:
+            created_dirs.add(compressed_dir)
+
+    error_compressing = False
+    error_message = None
+    try:
+        # Move the compressed file from the temporary cache directory to the final destination
+        file_transfer.move_file(temp_cached_file_path, temp_remote_file_path, **(transfer_kwargs or {}))
+    except OSError as e:
+        # That is a workaround when shutil is raising an error when copying file to samba share where you can't copy permissions
+        if e.errno == 95:
+            if os.path.isfile(temp_cached_file_path):
+                os.remove(temp_cached_file_path)
+        else:
+            logging_broadcast(f"Error compressing: {remote_file_path}\n" + str(e))
+            error_compressing = True
+            error_message = str(e)
+            if os.path.isfile(temp_cached_file_path):
+                os.remove(temp_cached_file_path)
+    if replace_files and error_compressing == False:
+        # Replace the original file with the compressed file
+        try:
+            shutil.move(temp_remote_file_path, remote_file_path)
+        except OSError as e:
+            if e.errno == 95:
+                pass
+            else:
+                logging_broadcast(f"Error compressing: {remote_file_path}\n" + str(e))
+                error_compressing = True
+                error_message = str(e)
+    file_record.update(upload_sec=time.perf_counter() - upload_start, upload_bytes=file_record['compressed_size'])
+
+    if error_compressing == False:
+        logging_broadcast(f"Compressed: {remote_file_path}, compression ratio: {round(file_record['ratio'], 2)}x")
+        # Only record the file as done once the compressed file is in its final place
+        record_processed_file(manifest, remote_file_path, STATUS_COMPRESSED, file_record, metrics, leases)
+    else:
+        record_processed_file(manifest, remote_file_path, STATUS_ERROR, file_record, metrics, leases,
+                              message=error_message)
+
+    progress.done(remote_file_path)
+    logging_broadcast("")
+    # Release the cache space after the compressed file has been copied to the remote location
+    cache_budget.release(cached_file_path)
+
+
+def upload_files(upload_queue: Channel, progress, cache_budget, manifest, replace_files, metrics=None,
+                 transfer_kwargs=None, leases=None, created_dirs=None):
+    """Moves compressed files from the cache to the remote location until the upload queue is closed."""
+    for upload_item in upload_queue:
+        if metrics is not None:
+            metrics.queue_depth(upload_queue.name, upload_queue.qsize())
+        try:
+            upload_compressed_file(upload_item, progress, cache_budget, manifest, replace_files, metrics, transfer_kwargs,
+                                   leases, created_dirs)
+        except BaseException:
+            if os.path.isfile(upload_item[0]):
+                os.remove(upload_item[0])
+            raise
+
+
+def merge_cooperative_results(manifest, input_path):
+    """
+    Moves the results of earlier cooperative runs, left next to their leases, into the manifest of the folder.
+    Only done by runs that are not cooperative, so the manifest has a single writer.
+    """
+    done_records = read_done_records(input_path)
+    if not done_records:
+        return
+    merged = manifest.import_records(record for _, record in done_records)
+    for done_path, _ in done_records:
+        os.remove(done_path)
+    logging_broadcast(f"Merged {merged} results of cooperative runs into {manifest.manifest_path}")
+
+
+def compress_tiff_files(input_path, cache_dir, quality, compression, threads, replace_files,
+                        memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB, workers=1, cache_budget_gb=None,
+                        upload_workers=DEFAULT_UPLOAD_WORKERS, estimate_ratio=True, metrics_file=None,
+                        prometheus_file=None, transfer_streams=file_transfer.DEFAULT_TRANSFER_STREAMS,
+                        transfer_block_mb=file_transfer.DEFAULT_TRANSFER_BLOCK_MB, input_location="auto", triage=True,
+                        recompress_compressed=False, level=None, predictor=False, auto_codec=False,
+                        auto_min_speed_mb_s=AUTO_DEFAULT_MIN_SPEED_MB_S, auto_min_ratio=None, output_format='tiff',
+                        watch=False, poll_interval_sec=DEFAULT_POLL_INTERVAL_SEC, settle_sec=DEFAULT_SETTLE_SEC,
+                        stop_event=None, cooperative=False, lease_ttl_sec=DEFAULT_LEASE_TTL_SEC, scheduling='found',
+                        verify=False):
     """
     Compresses the TIFF files in the given input path (folder or file) using the specified compression algorithm and quality percentage.
     Creates a new compressed TIFF file with the name '.part' and replaces the original file(s).
+    With 'auto_codec' the codec is picked per directory from AUTO_CODEC_CANDIDATES instead, see CodecSelector.
+    With 'watch' the folder is watched for new files after the existing ones are processed, until 'stop_event' is set.
+    With 'cooperative' several processes, on this or other computers, can work on the same folder at once:
+    every file is claimed with a lease first, see work_leases.WorkLeases.
+    'scheduling' is one of SCHEDULING_POLICIES. Largest first keeps all workers busy until the end, interleaved
+    copies small files while a large one is compressed.
+    With 'verify' the originals are only replaced once the compressed files decode to the same pixels, which
+    needs a lossless codec.
     """
+    args = (quality, compression, threads, replace_files, memory_budget_mb)
 
+    found_files = None
     if not os.path.isdir(input_path):
-        # Input path is a file
-        file_path = input_path
-        with tqdm(total=1, ncols=80, desc="Progress") as pbar:
-            compress_one_file(file_path, pbar, *args)
-        return True
-
+        # A single file goes through the same pipeline, recorded in the manifest of its folder
+        stat = os.stat(input_path)
+        found_files = [(input_path, stat.st_size, stat.st_mtime)]
+        input_path = os.path.dirname(os.path.abspath(input_path))
+        watch = False
 
     now = datetime.now()
     dt_string = now.strftime("%Y-%b-%d-%H%M%S")
@@ -175,71 +877,156 @@ def compress_tiff_files(input_path, cache_dir, *args):
                      datefmt='%d-%b-%y %H:%M:%S',
                      level=logging.INFO)
 
-    # Create a cache queue for the local file paths
-    cache_queue = queue.Queue()
-    
-    # Create a semaphore to control the cache size
-    semaphore = threading.Semaphore(MAX_FILES_IN_CACHE)
-
-    done_paths_file = os.path.join(input_path, COMPRESSED_FILES_FILE)
-    already_compressed_files = set()
-    if os.path.exists(done_paths_file):
-        with open(done_paths_file, 'r') as file:
-            for line in file:
-                file_path = line.strip()
-                already_compressed_files.add(file_path)
-        if already_compressed_files:
-            logging_broadcast(f"Skipping already compressed files listed in {done_paths_file}")
+    # Limit the cache size in bytes, letting at least one file be ready for every worker
+    cache_budget_bytes = int(cache_budget_gb * 1024 ** 3) if cache_budget_gb is not None else None
+    cache_budget = CacheBudget(cache_dir, cache_budget_bytes, max(MAX_FILES_IN_CACHE, workers + 1), output_format)
+
+    # The stages are connected by channels: found file paths (cheap to hold, so the crawl is never held up),
+    # cached files (bounded by the cache budget, and when compressing in place by the same number of files)
+    # and compressed files waiting for verification and upload
+    pipeline = Pipeline(f"Compression of {input_path}")
+    pipeline.on_cancel(cache_budget.cancel)
+    if scheduling == 'largest_first':
+        discovered_queue = pipeline.channel("discovered", key=lambda file_item: -file_item[1])
+    elif scheduling in ('smallest_first', 'interleaved'):
+        discovered_queue = pipeline.channel("discovered", key=lambda file_item: file_item[1],
+                                            interleave=scheduling == 'interleaved')
+    else:
+        discovered_queue = pipeline.channel("discovered")
+    cache_queue = pipeline.channel("cache", maxsize=cache_budget.max_files)
+    upload_queue = pipeline.channel("upload", maxsize=2 * upload_workers)
+    verify_queue = pipeline.channel("verify", maxsize=2 * workers) if verify else None
+
+    # Files skipped as already compressed are looked at again when they should be converted to the target codec
+    done_statuses = [status for status in DONE_STATUSES
+                     if not (recompress_compressed and status == STATUS_ALREADY_COMPRESSED)]
+    folder_manifest_path = os.path.join(input_path, MANIFEST_FILE)
+    if cooperative:
+        # SQLite's locking cannot be relied on over network shares, so workers only read the manifest of the folder.
+        # Each keeps its own in its cache, and they see each other's results through the records next to the leases
+        manifest = CompressionManifest(worker_manifest_path(cache_dir, input_path), root=input_path)
+        done_files = {**read_done_files(folder_manifest_path, done_statuses), **manifest.done_files(done_statuses)}
+    else:
+        manifest = CompressionManifest(folder_manifest_path)
+        imported_files = manifest.import_text_manifest(os.path.join(input_path, COMPRESSED_FILES_FILE))
+        if imported_files:
+            logging_broadcast(f"Imported {imported_files} already compressed files from {COMPRESSED_FILES_FILE}")
+        merge_cooperative_results(manifest, input_path)
+        done_files = manifest.done_files(done_statuses)
+    if done_files:
+        logging_broadcast(f"Skipping already processed files listed in {folder_manifest_path}")
+
+    # Files on a local disk are read in place, skipping the copy to the cache
+    if input_location == "auto":
+        direct = file_transfer.is_local_path(input_path)
     else:
-        with open(done_paths_file, 'w'):
-            pass
-                
+        direct = input_location == "local"
+    logging_broadcast(f"Input folder is treated as {'local, compressing files in place' if direct else 'remote, caching files in ' + cache_dir}")
+
+    transfer_kwargs = dict(streams=transfer_streams, block_size=int(transfer_block_mb * 1024 * 1024),
+                           retry_timeout=REMOTE_DISCONNECTING_TIMEOUT_SEC)
+
+    if metrics_file is None:
+        metrics_file = os.path.join(cache_dir, "%s-tiff_compression_metrics.jsonl" % dt_string)
+    metrics = MetricsSink(metrics_file, prometheus_file, stage_concurrency={
+        'decode': workers, 'encode': workers, 'verify': workers, 'upload': upload_workers})
+
+    codec_selector = CodecSelector(compression, quality, threads, level, predictor, manifest, auto_codec,
+                                   auto_min_speed_mb_s, auto_min_ratio)
 
+    leases = None
+    if cooperative:
+        # A lease is renewed several times within its time to live, so a slow renewal does not let it expire
+        leases = WorkLeases(input_path, ttl=lease_ttl_sec, heartbeat_interval=min(LEASE_HEARTBEAT_SEC, lease_ttl_sec / 3))
+        logging_broadcast(f"Working together with other processes on {input_path} as {leases.owner}")
 
-    remote_file_paths = []
-    for root, dirs, files in os.walk(input_path):
-        if COMPRESSED_FOLDER in dirs:
-            dirs.remove(COMPRESSED_FOLDER)
-        for file in files:
-            if file.endswith('.tiff') or file.endswith('.tif'):
-                file_path = os.path.join(root, file)
-                if file_path not in already_compressed_files:
-                    remote_file_paths.append(file_path)
+    def is_done(file_path, size, mtime):
+        # Replacing a file with its compressed version changes it, the manifest tells these apart from new files,
+        # and, when working together with other processes, the records they leave tell which files they finished
+        return (manifest.is_done(file_path, size, mtime, done_statuses)
+                or (leases is not None and leases.is_done(file_path, size, mtime, done_statuses)))
 
-    with tqdm(total=len(remote_file_paths) + len(already_compressed_files), ncols=80, desc="Progress") as pbar:
+    with manifest, metrics, tqdm(total=0, ncols=100, desc="Progress", unit='B', unit_scale=True,
+                                 unit_divisor=1024) as pbar:
+        progress = ByteProgress(pbar)
 
-        pbar.update(len(already_compressed_files))
-        pbar.refresh()
-        print("")
+        # Crawl the folder in the background, only files that are new or changed since they were processed are queued
+        # and, after reading their headers, only those that are not already compressed
+        triage_kwargs = None
+        if triage:
+            triage_kwargs = dict(cached_headers=manifest.cached_headers(), manifest=manifest, compression=compression,
+                                 recompress_compressed=recompress_compressed, metrics=metrics,
+                                 is_done=is_done if cooperative else None)
+        if watch:
+            # A failure stops watching this folder only, 'stop_event' is shared with the other folders
+            watch_cancel_event = threading.Event()
+            pipeline.on_cancel(watch_cancel_event.set)
+            # Inotify only sees changes made on this computer, files written to a share by others are found by polling
+            watcher = FolderWatcher(input_path, excluded_dirs=(COMPRESSED_FOLDER, LEASE_DIR),
+                                    poll_interval=poll_interval_sec, settle_sec=settle_sec,
+                                    use_inotify=file_transfer.is_local_path(input_path), stop_event=stop_event,
+                                    cancel_event=watch_cancel_event)
+            found_files = watcher.watch()
+            logging_broadcast(f"Watching {input_path} for new files "
+                              f"({'inotify' if watcher.inotify is not None else f'polling every {poll_interval_sec} s'})")
+        pipeline.stage("discover", discover_files, input_path, done_files, discovered_queue, progress, triage_kwargs,
+                       found_files, is_done if watch else None, outputs=(discovered_queue,))
 
-        # Copy files to the local cache buffer asynchronously
-        copy_thread = threading.Thread(target=copy_files_to_cache, args=(remote_file_paths, cache_dir, cache_queue, semaphore))
-        copy_thread.start()
+        # Copy files to the local cache buffer asynchronously. When watching, the files other workers still hold at
+        # the stop are left to them
+        pipeline.stage("copy", copy_files_to_cache, discovered_queue, cache_dir, cache_queue, cache_budget,
+                       codec_selector, manifest, progress, estimate_ratio, metrics, transfer_kwargs, direct, leases,
+                       is_done, wait_for_others=not watch, outputs=(cache_queue,))
 
-        # Process files from the cache queue
-        process_thread = threading.Thread(target=compress_one_file, args=(
-            remote_file_paths, pbar, cache_queue, semaphore, done_paths_file, *args))
-        process_thread.start()
+        # Process files from the cache queue, compressing in separate processes if there is more than one worker.
+        # The worker processes are spawned, forking this process while the other stages run could copy held locks
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) \
+            if workers > 1 else None
+        compressed_queue = verify_queue if verify else upload_queue
+        pipeline.stage("compress", compress_one_file, progress, cache_queue, cache_budget, manifest, *args,
+                       workers=workers, outputs=(compressed_queue,), executor=executor, upload_queue=compressed_queue,
+                       metrics=metrics, transfer_kwargs=transfer_kwargs, codec_selector=codec_selector,
+                       output_format=output_format, leases=leases, verify=verify)
 
-        # Wait for all files to be processed
-        cache_queue.join()
+        if verify:
+            # Check the compressed files while the next ones are compressed
+            pipeline.stage("verify", verify_files, verify_queue, upload_queue, progress, cache_budget, manifest,
+                           memory_budget_mb, executor, metrics, leases, workers=workers, outputs=(upload_queue,))
 
-        # Wait for the threads to complete
-        copy_thread.join()
-        process_thread.join()
+        # Upload compressed files to the remote location asynchronously, so uploads overlap with compression
+        pipeline.stage("upload", upload_files, upload_queue, progress, cache_budget, manifest, replace_files, metrics,
+                       transfer_kwargs, leases, created_dirs=set(), workers=upload_workers)
+
+        try:
+            pipeline.wait()
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+            # After a failure or Ctrl+C, remove the cached files that were not processed
+            for cached_file_path, remote_file_path, _ in cache_queue.drain():
+                if cached_file_path != remote_file_path:
+                    os.remove(cached_file_path)
+            for upload_item in upload_queue.drain() + (verify_queue.drain() if verify else []):
+                os.remove(upload_item[0])
+            if leases is not None:
+                leases.close()
+
+        logging_broadcast(f"Files in the manifest by status: {manifest.status_counts()}")
+        logging_broadcast(f"Total space saved: {round(manifest.total_bytes_saved() / 1024 ** 3, 2)} GB")
+        for line in metrics.summary():
+            logging_broadcast(line)
 
 
-@Gooey
 def main():
     parser = argparse.ArgumentParser(description="Compress TIFF files using different compression algorithms.")
     group = parser.add_mutually_exclusive_group(required=True)
-    group.add_argument('-d', '--folder', help="Path to the folder containing TIFF files.")
+    group.add_argument('-d', '--folder', nargs='+', help="Path to the folder containing TIFF files, or several folders.")
     group.add_argument('-f', '--file', help="Path to the TIFF file.")
 
     parser.add_argument(
         '-C',
         '--compression',
-        choices=['jpeg_2000_lossy', 'zlib', 'lzw'],
+        choices=['jpeg_2000_lossy', 'zlib', 'lzw', 'zstd'],
         default='zlib',
         help="Compression algorithm (default: jpeg_2000_lossy)")
     parser.add_argument(
@@ -248,31 +1035,206 @@ def main():
         type=int,
         help="Compression quality percentage (0-100). Required for jpeg_2000_lossy compression.",
         default=85)
+    parser.add_argument(
+        '--level',
+        type=int,
+        help="Compression level of zlib (1-9) or zstd (1-22). By default the default level of the codec.",
+        default=None)
+    parser.add_argument(
+        '--predictor',
+        action="store_true",
+        help="Use the horizontal differencing predictor with zlib, lzw or zstd, usually smaller for 16-bit microscopy images.",
+        default=False)
+    parser.add_argument(
+        '--auto',
+        action="store_true",
+        help="Pick codec, level and predictor per directory by trial-compressing pages sampled from a few of its files. "
+             "The choice is cached in the manifest.",
+        default=False)
+    parser.add_argument(
+        '--auto_min_speed_mbs',
+        type=float,
+        help="With --auto, pick the highest compression ratio among the codecs compressing at least this many MB/s.",
+        default=AUTO_DEFAULT_MIN_SPEED_MB_S)
+    parser.add_argument(
+        '--auto_min_ratio',
+        type=float,
+        help="With --auto, pick the fastest codec reaching this compression ratio instead.",
+        default=None)
     parser.add_argument(
         '--threads',
         type=int,
         help="Maximum number of threads to use (should be less that CPU cores).",
         default=None)
+    parser.add_argument(
+        '--workers',
+        type=int,
+        help="Number of files to compress at the same time in separate processes. "
+             "If --threads is not set, CPU cores are split evenly between the workers.",
+        default=1)
     parser.add_argument(
         '--cache_dir',
         type=str,
         help="Temporary directory on a fast local SSD, for better writing performance to network drives.",
         default=".")
+    parser.add_argument(
+        '--watch',
+        action="store_true",
+        help="Keep running and compress new files as they are written to the folders, until stopped with Ctrl+C or SIGTERM. "
+             "Run with --ignore-gooey to run without the GUI, e.g. as a service.",
+        default=False)
+    parser.add_argument(
+        '--poll_interval_sec',
+        type=float,
+        help="With --watch, how often folders on network shares are checked for new files.",
+        default=DEFAULT_POLL_INTERVAL_SEC)
+    parser.add_argument(
+        '--settle_sec',
+        type=float,
+        help="With --watch, a file is compressed once its size and modification time did not change for this long.",
+        default=DEFAULT_SETTLE_SEC)
+    parser.add_argument(
+        '--upload_workers',
+        type=int,
+        help="Number of compressed files uploaded to the remote location at the same time.",
+        default=DEFAULT_UPLOAD_WORKERS)
+    parser.add_argument(
+        '--input_location',
+        choices=['auto', 'local', 'remote'],
+        default='auto',
+        help="Local input folders are compressed in place without copying files to the cache directory, "
+             "remote ones are copied to the cache first. By default it is detected from the filesystem type.")
+    parser.add_argument(
+        '--transfer_streams',
+        type=int,
+        help="Number of parallel streams used to copy one large file to and from the cache.",
+        default=file_transfer.DEFAULT_TRANSFER_STREAMS)
+    parser.add_argument(
+        '--transfer_block_mb',
+        type=float,
+        help="Size of the blocks (in MB) copied at once by every transfer stream.",
+        default=file_transfer.DEFAULT_TRANSFER_BLOCK_MB)
+    parser.add_argument(
+        '--cache_budget_gb',
+        type=float,
+        help="Maximum space (in GB) used in the cache directory, counting cached files and their compressed output. "
+             "By default half of the free space in the cache directory.",
+        default=None)
     parser.add_argument(
         '--do_not_replace',
         action="store_true",
         help="Replace files at the destination? If enabled places file with extension '.part' beside original.",
         default=False)
+    parser.add_argument(
+        '--no_ratio_estimate',
+        action="store_true",
+        help="Do not estimate the compression ratio from a few sampled pages before caching large files.",
+        default=False)
+    parser.add_argument(
+        '--no_triage',
+        action="store_true",
+        help="Do not read the TIFF headers to skip files that are already compressed or have no images.",
+        default=False)
+    parser.add_argument(
+        '--recompress_compressed',
+        action="store_true",
+        help="Convert files that are already compressed with a different codec to the chosen compression.",
+        default=False)
+    parser.add_argument(
+        '--metrics_file',
+        type=str,
+        help="JSON lines file with per-file stage timings (default: next to the log file in the cache directory).",
+        default=None)
+    parser.add_argument(
+        '--prometheus_file',
+        type=str,
+        help="File to write pipeline metrics to in the Prometheus text format, e.g. for the node_exporter textfile collector.",
+        default=None)
+    parser.add_argument(
+        '--memory_budget_mb',
+        type=int,
+        help="Maximum size of image data (in MB) held in memory at once. Larger images are recompressed tile by tile.",
+        default=DEFAULT_MEMORY_BUDGET_MB)
+    parser.add_argument(
+        '--output_format',
+        choices=OUTPUT_FORMATS,
+        default='tiff',
+        help="'tiled' writes tiled TIFF files, 'pyramid' and 'ome_pyramid' add subresolution levels "
+             "(as OME-TIFF for 'ome_pyramid'), so viewers like napari only load what they show.")
+    parser.add_argument(
+        '--verify',
+        action="store_true",
+        help="Replace originals only after checking that the compressed file decodes to the same pixels. "
+             "The pixel hashes are stored in the manifest. Needs a lossless compression.",
+        default=False)
+    parser.add_argument(
+        '--scheduling',
+        choices=SCHEDULING_POLICIES,
+        default='found',
+        help="Order in which files are processed: as they are found, largest or smallest first, or alternately "
+             "the largest and the smallest, which keeps copying, compression and upload busy at the same time.")
+    parser.add_argument(
+        '--cooperative',
+        action="store_true",
+        help="Work on the folder together with other instances of the script, on this or other computers. "
+             "Each file is claimed with a lease in the _compression_leases folder. Every instance needs its own cache_dir "
+             "and keeps its own manifest there, the next run without --cooperative merges the results.",
+        default=False)
+    parser.add_argument(
+        '--lease_ttl_sec',
+        type=int,
+        help="Seconds after which the lease of an instance that stopped renewing it, e.g. because it crashed, "
+             "is taken over by another instance.",
+        default=DEFAULT_LEASE_TTL_SEC)
 
     args = parser.parse_args()
+    if args.level is not None and args.compression not in LEVEL_COMPRESSIONS and not args.auto:
+        parser.error(f"--level is not supported by {args.compression}, only by zlib and zstd.")
+    if args.verify and args.compression == 'jpeg_2000_lossy' and not args.auto:
+        parser.error("--verify needs a lossless compression, jpeg_2000_lossy changes the pixels.")
+    workers = max(1, args.workers)
+    threads = split_cpu_cores(workers, args.threads)
 
-    if args.folder:
-        compress_tiff_files(args.folder, args.cache_dir, args.quality, args.compression,
-                            args.threads, not args.do_not_replace)
+    stop_event = threading.Event()
+    if args.watch:
+        # Let the files being processed finish and leave the manifest consistent
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *_: stop_event.set())
+
+    def compress_path(path):
+        compress_tiff_files(path, args.cache_dir, args.quality, args.compression,
+                            threads, not args.do_not_replace, args.memory_budget_mb, workers=workers,
+                            cache_budget_gb=args.cache_budget_gb, upload_workers=max(1, args.upload_workers),
+                            estimate_ratio=not args.no_ratio_estimate, metrics_file=args.metrics_file,
+                            prometheus_file=args.prometheus_file, transfer_streams=max(1, args.transfer_streams),
+                            transfer_block_mb=args.transfer_block_mb, input_location=args.input_location,
+                            triage=not args.no_triage, recompress_compressed=args.recompress_compressed,
+                            level=args.level, predictor=args.predictor, auto_codec=args.auto,
+                            auto_min_speed_mb_s=args.auto_min_speed_mbs, auto_min_ratio=args.auto_min_ratio,
+                            output_format=args.output_format, watch=args.watch,
+                            poll_interval_sec=args.poll_interval_sec, settle_sec=args.settle_sec, stop_event=stop_event,
+                            cooperative=args.cooperative, lease_ttl_sec=args.lease_ttl_sec,
+                            scheduling=args.scheduling, verify=args.verify)
+
+    if args.folder and args.watch:
+        # Every folder has its own manifest and pipeline, watched at the same time
+        folder_threads = [threading.Thread(target=compress_path, args=(folder,)) for folder in args.folder]
+        for folder_thread in folder_threads:
+            folder_thread.start()
+        for folder_thread in folder_threads:
+            folder_thread.join()
+    elif args.folder:
+        for folder in args.folder:
+            compress_path(folder)
     elif args.file:
-        compress_tiff_files(args.file, args.cache_dir, args.quality, args.compression,
-                            args.threads, not args.do_not_replace)
+        compress_path(args.file)
 
 
 if __name__ == '__main__':
-    main()
+    if '--ignore-gooey' in sys.argv:
+        # Importing Gooey takes seconds, which headless runs like --watch services do not need to wait for
+        sys.argv.remove('--ignore-gooey')
+        main()
+    else:
+        from gooey import Gooey
+        Gooey(main)()
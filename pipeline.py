@@ -0,0 +1,234 @@
+import collections
+import heapq
+import itertools
+import logging
+import threading
+
+
+class PipelineCancelled(Exception):
+    """Raised in a stage waiting on a channel once the pipeline is cancelled."""
+
+
+class Channel:
+    """
+    FIFO connecting the stages of a Pipeline.
+    put() blocks while 'maxsize' items are waiting, so a fast stage cannot run ahead of a slow one; 0 is unbounded.
+    The channel is closed once its 'producers' stages are finished, iterating over it then ends after the last item.
+    Items are handed over as soon as they are put, put() and iteration raise PipelineCancelled when the pipeline is
+    cancelled, also while they wait.
+    """
+
+    def __init__(self, pipeline, name, maxsize=0, producers=1):
+        self.pipeline = pipeline
+        self.name = name
+        self.maxsize = maxsize
+        self.open_producers = producers
+        self.items = collections.deque()
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+
+    @property
+    def cancelled(self):
+        return self.pipeline.cancelled
+
+    def put(self, item):
+        with self.not_full:
+            while self.maxsize and self._count() >= self.maxsize and not self.cancelled:
+                self.not_full.wait()
+            if self.cancelled:
+                raise PipelineCancelled(f"{self.pipeline.name} was cancelled")
+            self._push(item)
+            self.not_empty.notify()
+
+    def __iter__(self):
+        return self.iterate()
+
+    def iterate(self, on_idle=None, idle_timeout=None):
+        """
+        Iterates over the items like the channel itself, calling 'on_idle' before it waits for the next one.
+        With 'idle_timeout' None is yielded whenever no item came for that many seconds, so the consumer can look
+        after other work while the producers are idle.
+        """
+        while True:
+            if on_idle is not None:
+                with self.lock:
+                    idle = not self._count() and self.open_producers and not self.cancelled
+                if idle:
+                    on_idle()
+            with self.not_empty:
+                timed_out = False
+                while not self._count() and self.open_producers and not self.cancelled and not timed_out:
+                    timed_out = not self.not_empty.wait(idle_timeout)
+                if self.cancelled:
+                    raise PipelineCancelled(f"{self.pipeline.name} was cancelled")
+                if self._count():
+                    item = self._pop()
+                    self.not_full.notify()
+                elif timed_out:
+                    item = None
+                else:
+                    return
+            yield item
+
+    def qsize(self):
+        with self.lock:
+            return self._count()
+
+    def close(self):
+        """Called once by every producer stage when it is finished."""
+        with self.lock:
+            self.open_producers -= 1
+            self.not_empty.notify_all()
+
+    def drain(self):
+        """Removes and returns the items left over, after the pipeline was cancelled."""
+        with self.lock:
+            items = []
+            while self._count():
+                items.append(self._pop())
+            self.not_full.notify_all()
+        return items
+
+    def _push(self, item):
+        self.items.append(item)
+
+    def _pop(self):
+        return self.items.popleft()
+
+    def _count(self):
+        return len(self.items)
+
+    def _wake(self):
+        with self.lock:
+            self.not_empty.notify_all()
+            self.not_full.notify_all()
+
+
+class PriorityChannel(Channel):
+    """
+    Channel handing out the waiting item with the lowest 'key(item)' first. With 'interleave' it alternates between
+    the item with the highest and the one with the lowest key, starting with the highest.
+    Items with the same key are handed out in the order they were put.
+    """
+
+    def __init__(self, pipeline, name, key, maxsize=0, producers=1, interleave=False):
+        super().__init__(pipeline, name, maxsize, producers)
+        self.key = key
+        self.interleave = interleave
+        self.lowest = []
+        self.highest = []
+        # Items taken from one heap stay in the other until they come up there, they are skipped then
+        self.taken = set()
+        self.counter = itertools.count()
+        self.take_highest = interleave
+        self.size = 0
+
+    def _push(self, item):
+        key = self.key(item)
+        sequence = next(self.counter)
+        self.size += 1
+        heapq.heappush(self.lowest, (key, sequence, item))
+        if self.interleave:
+            heapq.heappush(self.highest, (-key, sequence, item))
+
+    def _pop(self):
+        heap = self.highest if self.take_highest else self.lowest
+        self.take_highest = self.interleave and not self.take_highest
+        self.size -= 1
+        while True:
+            _, sequence, item = heapq.heappop(heap)
+            if sequence in self.taken:
+                self.taken.remove(sequence)
+                continue
+            if self.interleave:
+                self.taken.add(sequence)
+            return item
+
+    def _count(self):
+        return self.size
+
+
+class Pipeline:
+    """
+    Stages running in threads, connected by Channels.
+    Each stage is a function run by one or more worker threads, reading from and writing to channels. When all workers
+    of a stage returned, its output channels are closed, so the stages after it finish once they processed everything.
+    An exception in a stage cancels the pipeline: the other stages stop at their next channel operation,
+    and wait() raises the exception once all threads ended. Ctrl+C while waiting cancels the pipeline as well.
+    """
+
+    def __init__(self, name="pipeline"):
+        self.name = name
+        self.cancel_event = threading.Event()
+        self.channels = []
+        self.threads = []
+        self.errors = []
+        self.cancel_callbacks = []
+        self.lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def channel(self, name, maxsize=0, producers=1, key=None, interleave=False):
+        """Returns a FIFO Channel, or with 'key' a PriorityChannel."""
+        if key is not None:
+            channel = PriorityChannel(self, name, key, maxsize, producers, interleave)
+        else:
+            channel = Channel(self, name, maxsize, producers)
+        self.channels.append(channel)
+        return channel
+
+    def on_cancel(self, callback):
+        """Calls 'callback' when the pipeline is cancelled, to wake up stages waiting on something else than a channel."""
+        self.cancel_callbacks.append(callback)
+
+    def stage(self, name, target, *args, workers=1, outputs=(), **kwargs):
+        """Starts 'workers' threads running target(*args, **kwargs), closing the 'outputs' channels after the last one."""
+        remaining = [workers]
+
+        def run():
+            try:
+                target(*args, **kwargs)
+            except PipelineCancelled:
+                pass
+            except BaseException as e:
+                logging.exception(f"Stage {name} of {self.name} failed")
+                self.cancel(e)
+            finally:
+                with self.lock:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                if last:
+                    for channel in outputs:
+                        channel.close()
+
+        for index in range(workers):
+            thread = threading.Thread(target=run, name=f"{name}-{index}")
+            thread.start()
+            self.threads.append(thread)
+
+    def cancel(self, error=None):
+        with self.lock:
+            if error is not None:
+                self.errors.append(error)
+            if self.cancel_event.is_set():
+                return
+            self.cancel_event.set()
+        for channel in self.channels:
+            channel._wake()
+        for callback in self.cancel_callbacks:
+            callback()
+
+    def wait(self):
+        """Waits for all stages to finish, raising the first exception of a stage."""
+        try:
+            for thread in self.threads:
+                thread.join()
+        except KeyboardInterrupt as e:
+            self.cancel(e)
+            for thread in self.threads:
+                thread.join()
+        if self.errors:
+            raise self.errors[0]
@@ -0,0 +1,186 @@
+import json
+import os
+import threading
+import time
+
+PROMETHEUS_WRITE_INTERVAL_SEC = 15
+PROMETHEUS_PREFIX = "tiff_compression"
+
+# Per-file timings collected by the pipeline, with the stage they belong to and the bytes that stage moved
+STAGE_TIMINGS = {
+    'copy': ('copy_sec', 'copy_bytes'),
+    'decode': ('decode_sec', None),
+    'encode': ('encode_sec', None),
+    'verify': ('verify_sec', None),
+    'upload': ('upload_sec', 'upload_bytes'),
+}
+# Time spent waiting for the remote share to reconnect and for space in the cache
+WAIT_TIMINGS = {'remote': 'remote_wait_sec', 'cache': 'cache_wait_sec'}
+
+
+class MetricsSink:
+    """
+    Collects per-file metrics of the caching pipeline.
+    Every finished file is written as one JSON line to 'jsonl_path', stage totals and queue depths are written to
+    'prometheus_path' in the Prometheus text format (for the node_exporter textfile collector) by a background thread
+    every PROMETHEUS_WRITE_INTERVAL_SEC, so they stay current while a long file is processed.
+    Queue depths are sampled by the stages whenever they put an item on a queue or take one off it.
+    Both paths are optional, totals are always kept for the summary at the end of the run.
+    'stage_concurrency' gives the number of threads or processes working on each stage.
+    """
+
+    def __init__(self, jsonl_path=None, prometheus_path=None, stage_concurrency=None):
+        self.jsonl_path = jsonl_path
+        self.prometheus_path = prometheus_path
+        self.stage_concurrency = stage_concurrency or {}
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.stage_seconds = {stage: 0.0 for stage in STAGE_TIMINGS}
+        self.stage_bytes = {stage: 0 for stage in STAGE_TIMINGS}
+        self.wait_seconds = {name: 0.0 for name in WAIT_TIMINGS}
+        self.status_counts = {}
+        self.queue_depths = {}
+        self.jsonl_file = open(jsonl_path, 'a') if jsonl_path else None
+        self.stop_event = threading.Event()
+        self.prometheus_thread = None
+        if prometheus_path:
+            self.prometheus_thread = threading.Thread(target=self._write_prometheus_periodically, daemon=True)
+            self.prometheus_thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def queue_depth(self, name, depth):
+        with self.lock:
+            self.queue_depths[name] = depth
+
+    def file_done(self, path, status, file_record):
+        with self.lock:
+            for stage, (seconds_field, bytes_field) in STAGE_TIMINGS.items():
+                self.stage_seconds[stage] += file_record.get(seconds_field) or 0.0
+                if bytes_field is not None:
+                    self.stage_bytes[stage] += file_record.get(bytes_field) or 0
+            for name, field in WAIT_TIMINGS.items():
+                self.wait_seconds[name] += file_record.get(field) or 0.0
+            self.status_counts[status] = self.status_counts.get(status, 0) + 1
+            if self.jsonl_file is not None:
+                event = {'time': time.time(), 'path': path, 'status': status, **file_record}
+                for stage, (seconds_field, bytes_field) in STAGE_TIMINGS.items():
+                    if bytes_field is not None and file_record.get(seconds_field):
+                        event[f"{stage}_mb_per_sec"] = (file_record.get(bytes_field) or 0) / 1024 ** 2 / file_record[seconds_field]
+                self.jsonl_file.write(json.dumps(event) + "\n")
+                self.jsonl_file.flush()
+
+    def _write_prometheus_periodically(self):
+        while not self.stop_event.wait(PROMETHEUS_WRITE_INTERVAL_SEC):
+            with self.lock:
+                self._write_prometheus()
+
+    def _write_prometheus(self):
+        if not self.prometheus_path:
+            return
+        lines = [
+            f"# HELP {PROMETHEUS_PREFIX}_stage_seconds_total Time spent in each pipeline stage.",
+            f"# TYPE {PROMETHEUS_PREFIX}_stage_seconds_total counter",
+        ]
+        lines += [f'{PROMETHEUS_PREFIX}_stage_seconds_total{{stage="{stage}"}} {seconds}'
+                  for stage, seconds in self.stage_seconds.items()]
+        lines += [
+            f"# HELP {PROMETHEUS_PREFIX}_stage_bytes_total Bytes transferred by each pipeline stage.",
+            f"# TYPE {PROMETHEUS_PREFIX}_stage_bytes_total counter",
+        ]
+        lines += [f'{PROMETHEUS_PREFIX}_stage_bytes_total{{stage="{stage}"}} {nbytes}'
+                  for stage, nbytes in self.stage_bytes.items() if STAGE_TIMINGS[stage][1] is not None]
+        lines += [
+            f"# HELP {PROMETHEUS_PREFIX}_wait_seconds_total Time spent waiting for the remote share or cache space.",
+            f"# TYPE {PROMETHEUS_PREFIX}_wait_seconds_total counter",
+        ]
+        lines += [f'{PROMETHEUS_PREFIX}_wait_seconds_total{{wait="{name}"}} {seconds}'
+                  for name, seconds in self.wait_seconds.items()]
+        lines += [
+            f"# HELP {PROMETHEUS_PREFIX}_files_total Processed files by status.",
+            f"# TYPE {PROMETHEUS_PREFIX}_files_total counter",
+        ]
+        lines += [f'{PROMETHEUS_PREFIX}_files_total{{status="{status}"}} {count}'
+                  for status, count in self.status_counts.items()]
+        lines += [
+            f"# HELP {PROMETHEUS_PREFIX}_queue_depth Files waiting in each pipeline queue.",
+            f"# TYPE {PROMETHEUS_PREFIX}_queue_depth gauge",
+        ]
+        lines += [f'{PROMETHEUS_PREFIX}_queue_depth{{queue="{name}"}} {depth}'
+                  for name, depth in self.queue_depths.items()]
+        # Write to a temporary file first, so the exporter never reads a partial file
+        temp_path = self.prometheus_path + ".tmp"
+        with open(temp_path, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temp_path, self.prometheus_path)
+
+    def summary(self):
+        """
+        Returns the summary lines of the run. The bottleneck is the stage with the highest utilisation,
+        its busy time divided by the wall time and the number of threads or processes working on it.
+        """
+        with self.lock:
+            wall_sec = time.perf_counter() - self.start
+            lines = [f"Run time: {round(wall_sec, 1)} s, files by status: {self.status_counts}"]
+            utilisation = {}
+            for stage, seconds in self.stage_seconds.items():
+                concurrency = self.stage_concurrency.get(stage, 1)
+                utilisation[stage] = seconds / (wall_sec * concurrency) if wall_sec > 0 else 0.0
+                line = f"Stage {stage}: {round(seconds, 1)} s busy, {round(100 * utilisation[stage], 1)}% utilised"
+                if STAGE_TIMINGS[stage][1] is not None and seconds > 0:
+                    line += f", {round(self.stage_bytes[stage] / 1024 ** 2 / seconds, 1)} MB/s"
+                lines.append(line)
+            for name, seconds in self.wait_seconds.items():
+                lines.append(f"Waiting for {name}: {round(seconds, 1)} s")
+            if any(utilisation.values()):
+                lines.append(f"Bottleneck: {max(utilisation, key=utilisation.get)} stage")
+        return lines
+
+    def close(self):
+        self.stop_event.set()
+        if self.prometheus_thread is not None:
+            self.prometheus_thread.join()
+        with self.lock:
+            self._write_prometheus()
+            if self.jsonl_file is not None:
+                self.jsonl_file.close()
+                self.jsonl_file = None
+
+
+class ByteProgress:
+    """
+    Progress of the pipeline in bytes on a tqdm bar, so its rate and ETA follow the throughput of the pipeline
+    instead of the number of files, which means little when one file is 80 GB and the others 5 MB.
+    Files are added with their size once it is known they need processing, and count when they are done.
+    Files dropped on the way, for example because another process took them, are taken off the total again.
+    """
+
+    def __init__(self, pbar):
+        self.pbar = pbar
+        self.sizes = {}
+        self.files_done = 0
+        self.lock = threading.Lock()
+
+    def add(self, path, size):
+        with self.lock:
+            self.sizes[path] = size
+            self.pbar.total += size
+            self._update(0)
+
+    def done(self, path):
+        with self.lock:
+            self.files_done += 1
+            self._update(self.sizes.pop(path, 0))
+
+    def skip(self, path):
+        with self.lock:
+            self.pbar.total -= self.sizes.pop(path, 0)
+            self._update(0)
+
+    def _update(self, nbytes):
+        self.pbar.set_postfix_str(f"{self.files_done}/{self.files_done + len(self.sizes)} files", refresh=False)
+        self.pbar.update(nbytes)
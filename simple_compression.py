@@ -0,0 +1,105 @@
+import os
+import shutil
+from tqdm import tqdm
+from pipeline import Channel, Pipeline
+from tiff_streaming import DEFAULT_MEMORY_BUDGET_MB, get_write_kwargs, stream_recompress
+
+
+def compress_one_file(file_path, quality, compression, threads, cache_dir, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB,
+                      output_format='tiff'):
+    """Writes the compressed copy of a file with the extension '.part', into 'cache_dir' if given, and returns its path."""
+    temp_file_path = file_path + '.part'
+    if cache_dir:
+        temp_file_path = os.path.join(cache_dir, os.path.basename(temp_file_path))
+
+    # Compress the TIFF file using the specified algorithm and quality
+    # Stream the file page by page (or tile by tile) so memory use is bounded by the budget, not the file size
+    stream_recompress(file_path, temp_file_path, get_write_kwargs(compression, quality, threads),
+                      memory_budget_mb * 1024 * 1024, output_format=output_format)
+    return temp_file_path
+
+
+def move_compressed_file(file_path, temp_file_path, replace_files):
+    """Moves the compressed copy from the cache directory beside the original, and replaces the original with it."""
+    temp_file_path_beside_original = file_path + '.part'
+    if temp_file_path != temp_file_path_beside_original:
+        try:
+            # Move the compressed file from the temporary cache directory to the final destination
+            shutil.move(temp_file_path, temp_file_path_beside_original)
+        except OSError as e:
+            # That is a workaround when shutil is raising an error when copying file to samba share where you can't copy permissions
+            if e.errno == 95:
+                if os.path.isfile(temp_file_path):
+                    os.remove(temp_file_path)
+            else:
+                print(f"Error compressing: {file_path}\n" + str(e))
+    if replace_files:
+        # Replace the original file with the compressed file
+        try:
+            shutil.move(temp_file_path_beside_original, file_path)
+        except OSError as e:
+            if e.errno == 95:
+                pass
+            else:
+                print(f"Error compressing: {file_path}\n" + str(e))
+    print(f"Compressed: {file_path}")
+
+
+def compress_listed_files(file_paths, compressed_files: Channel, pbar, quality, compression, threads, cache_dir,
+                          memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB, output_format='tiff'):
+    for file_path in file_paths:
+        try:
+            temp_file_path = compress_one_file(file_path, quality, compression, threads, cache_dir, memory_budget_mb,
+                                               output_format)
+        except Exception as e:
+            print(f"Error compressing: {file_path}")
+            print(e)
+            pbar.update(1)
+            continue
+        compressed_files.put((file_path, temp_file_path))
+
+
+def move_compressed_files(compressed_files: Channel, pbar, replace_files):
+    for file_path, temp_file_path in compressed_files:
+        move_compressed_file(file_path, temp_file_path, replace_files)
+        pbar.update(1)
+
+
+def compress_files(file_paths, pbar, quality, compression, threads, cache_dir, replace_files,
+                   memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB, output_format='tiff'):
+    """
+    Compresses the files in a Pipeline of two stages, so the next file is compressed while the previous one is moved
+    from the cache directory to the network drive. An unexpected error or Ctrl+C stops both stages.
+    """
+    pipeline = Pipeline("Compression")
+    compressed_files = pipeline.channel("compressed", maxsize=1)
+    pipeline.stage("compress", compress_listed_files, file_paths, compressed_files, pbar, quality, compression, threads,
+                   cache_dir, memory_budget_mb, output_format, outputs=(compressed_files,))
+    pipeline.stage("move", move_compressed_files, compressed_files, pbar, replace_files)
+    try:
+        pipeline.wait()
+    finally:
+        for _, temp_file_path in compressed_files.drain():
+            os.remove(temp_file_path)
+
+
+def compress_tiff_files(input_path, *args):
+    """
+    Compresses the TIFF files in the given input path (folder or file) using the specified compression algorithm and quality percentage.
+    Creates a new compressed TIFF file with the name '.part' and replaces the original file(s).
+    """
+    if os.path.isdir(input_path):
+        # Input path is a folder
+        tiff_files = []
+        for root, _, files in os.walk(input_path):
+            for file in files:
+                if file.endswith('.tiff') or file.endswith('.tif'):
+                    tiff_files.append(os.path.join(root, file))
+
+        with tqdm(total=len(tiff_files), ncols=80, desc="Progress") as pbar:
+            compress_files(tiff_files, pbar, *args)
+    else:
+        # Input path is a file
+        file_path = input_path
+        with tqdm(total=1, ncols=80, desc="Progress") as pbar:
+            compress_files([file_path], pbar, *args)
@@ -0,0 +1,134 @@
+import json
+import os
+import subprocess
+import sqlite3
+import sys
+import threading
+import time
+import numpy
+import tifffile
+from tqdm import tqdm
+from compression_manifest import MANIFEST_FILE, STATUS_COMPRESSED, relative_key
+from full_caching_compress_tiffs import claim_files
+from pipeline_metrics import ByteProgress
+from work_leases import DONE_SUFFIX, LEASE_DIR, WorkLeases, read_done_records
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "full_caching_compress_tiffs.py")
+PROCESSES = 3
+FILES = 24
+PROCESS_TIMEOUT_SEC = 300
+
+
+def write_folder(folder):
+    paths = []
+    for i in range(FILES):
+        directory = os.path.join(folder, f"dir{i % 3}")
+        os.makedirs(directory, exist_ok=True)
+        stack = numpy.zeros((4, 256, 256), 'uint16')
+        stack[:, :64] = i
+        paths.append(os.path.join(directory, f"file{i}.tif"))
+        tifffile.imwrite(paths[-1], stack, photometric='minisblack')
+    return paths
+
+
+def start_process(folder, cache_dir, *args):
+    os.makedirs(cache_dir)
+    return subprocess.Popen(
+        [sys.executable, SCRIPT, '--ignore-gooey', '-d', folder, '--cache_dir', cache_dir, '--input_location', 'remote',
+         '--no_ratio_estimate', *args],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def run_processes(folder, cache_root):
+    # A short time to live makes the workers look again at the files of the others every second
+    processes = [start_process(folder, os.path.join(cache_root, f"cache{index}"), '--cooperative', '--lease_ttl_sec', '3')
+                 for index in range(PROCESSES)]
+    assert [process.wait(timeout=PROCESS_TIMEOUT_SEC) for process in processes] == [0] * PROCESSES
+
+
+def compressions_per_file(folder, cache_root):
+    """Counts the files each process compressed, from the metrics every process writes to its cache."""
+    counts = {}
+    for cache_dir in [os.path.join(cache_root, name) for name in os.listdir(cache_root) if 'cache' in name]:
+        for name in os.listdir(cache_dir):
+            if name.endswith("metrics.jsonl"):
+                with open(os.path.join(cache_dir, name)) as metrics_file:
+                    for line in metrics_file:
+                        record = json.loads(line)
+                        if record.get('status') == STATUS_COMPRESSED:
+                            path = relative_key(folder, record['path'])
+                            counts[path] = counts.get(path, 0) + 1
+    return counts
+
+
+def check_compressed_once(folder, cache_root, paths):
+    relative_paths = {relative_key(folder, path) for path in paths}
+    counts = compressions_per_file(folder, cache_root)
+    assert set(counts) == relative_paths
+    assert set(counts.values()) == {1}
+    for path in paths:
+        with tifffile.TiffFile(path) as tiff:
+            assert tiff.pages[0].compression != tifffile.COMPRESSION.NONE
+    # No lease is left, and the workers did not write to the manifest of the folder
+    done_records = read_done_records(folder)
+    assert not [name for name in os.listdir(os.path.join(folder, LEASE_DIR)) if not name.endswith(DONE_SUFFIX)]
+    assert sorted((record['path'], record['status']) for _, record in done_records) == \
+        sorted((path, STATUS_COMPRESSED) for path in relative_paths)
+    assert not os.path.exists(os.path.join(folder, MANIFEST_FILE))
+
+    # The next run on its own merges their results into the manifest and has nothing left to do
+    process = start_process(folder, os.path.join(cache_root, "merge_cache"))
+    assert process.wait(timeout=PROCESS_TIMEOUT_SEC) == 0
+    with sqlite3.connect(os.path.join(folder, MANIFEST_FILE)) as connection:
+        rows = connection.execute("SELECT path, status FROM files").fetchall()
+    assert sorted(rows) == sorted((path, STATUS_COMPRESSED) for path in relative_paths)
+    assert read_done_records(folder) == []
+    assert compressions_per_file(folder, cache_root) == counts
+
+
+def test_processes_compress_each_file_once(tmp_path):
+    folder = str(tmp_path / "share")
+    paths = write_folder(folder)
+    run_processes(folder, str(tmp_path))
+    check_compressed_once(folder, str(tmp_path), paths)
+
+
+def test_stale_lease_is_taken_over(tmp_path):
+    folder = str(tmp_path / "share")
+    paths = write_folder(folder)
+    # Left behind by a worker that crashed long ago
+    with WorkLeases(folder) as leases:
+        lease_path = leases._lease_path(paths[0])
+    with open(lease_path, 'w') as lease:
+        lease.write(f"crashed-host:1:00000000\n{paths[0]}\n")
+    os.utime(lease_path, (time.time() - 3600, time.time() - 3600))
+    run_processes(folder, str(tmp_path))
+    check_compressed_once(folder, str(tmp_path), paths)
+
+
+def test_expired_lease_is_taken_over_while_files_keep_coming(tmp_path):
+    folder = str(tmp_path / "share")
+    paths = write_folder(folder)[:2]
+    with WorkLeases(folder, ttl=1, heartbeat_interval=0.2) as leases:
+        # The first file is held by a worker that crashes right away
+        with open(leases._lease_path(paths[0]), 'w') as lease:
+            lease.write(f"crashed-host:1:00000000\n{paths[0]}\n")
+        deadline = time.monotonic() + 10
+
+        def watched_files():
+            # Like a watched folder the stream does not end, it yields None while no new files come
+            for path in paths:
+                yield path, os.path.getsize(path)
+            while time.monotonic() < deadline:
+                time.sleep(0.1)
+                yield None
+
+        claimed = []
+        with tqdm(total=0, disable=True) as pbar:
+            for path, _ in claim_files(watched_files(), leases, lambda *_: False, ByteProgress(pbar),
+                                       threading.Event(), retry_interval=0.2, wait_for_others=False):
+                claimed.append(path)
+                if len(claimed) == len(paths):
+                    break
+        assert claimed == [paths[1], paths[0]]
+        assert time.monotonic() < deadline
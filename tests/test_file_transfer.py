@@ -0,0 +1,72 @@
+import errno
+import os
+import time
+import pytest
+import file_transfer
+
+BLOCK_SIZE = 64 * 1024
+FILE_SIZE = 1024 * 1024 + 123
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = str(tmp_path / "source.bin")
+    with open(path, 'wb') as file:
+        file.write(os.urandom(FILE_SIZE))
+    return path
+
+
+@pytest.fixture(autouse=True)
+def no_retry_sleep(monkeypatch):
+    monkeypatch.setattr(file_transfer, 'TRANSFER_RETRY_INTERVAL_SEC', 0)
+
+
+def fail_once_at(monkeypatch, fail_offset, error_number):
+    """Makes _copy_range fail once at 'fail_offset' and returns the offsets it was called with."""
+    copy_range = file_transfer._copy_range
+    offsets = []
+
+    def flaky_copy_range(src_fd, dst_fd, offset, count):
+        offsets.append(offset)
+        if offset == fail_offset and offsets.count(offset) == 1:
+            raise OSError(error_number, os.strerror(error_number))
+        return copy_range(src_fd, dst_fd, offset, count)
+
+    monkeypatch.setattr(file_transfer, '_copy_range', flaky_copy_range)
+    return offsets
+
+
+@pytest.mark.parametrize('streams', [1, 4])
+def test_interrupted_copy_resumes_at_the_failed_block(tmp_path, monkeypatch, source, streams):
+    monkeypatch.setattr(file_transfer, 'PARALLEL_TRANSFER_MIN_BYTES', 0)
+    fail_offset = 3 * BLOCK_SIZE
+    offsets = fail_once_at(monkeypatch, fail_offset, errno.EIO)
+    destination = str(tmp_path / "destination.bin")
+    assert file_transfer.copy_file(source, destination, streams=streams, block_size=BLOCK_SIZE) == FILE_SIZE
+    with open(source, 'rb') as src, open(destination, 'rb') as dst:
+        assert src.read() == dst.read()
+    # Only the failed block is copied again, the blocks before it are not
+    assert offsets.count(fail_offset) == 2
+    assert len(offsets) == len(set(offsets)) + 1
+
+
+def test_permanent_error_fails_without_retrying(tmp_path, monkeypatch, source):
+    offsets = fail_once_at(monkeypatch, 2 * BLOCK_SIZE, errno.ENOSPC)
+    start = time.monotonic()
+    with pytest.raises(OSError) as error:
+        file_transfer.copy_file(source, str(tmp_path / "destination.bin"), streams=1, block_size=BLOCK_SIZE,
+                                retry_timeout=60)
+    assert error.value.errno == errno.ENOSPC
+    assert offsets[-1] == 2 * BLOCK_SIZE
+    assert time.monotonic() - start < 5
+
+
+def test_retries_stop_after_the_timeout(tmp_path, monkeypatch, source):
+    def failing_copy_range(src_fd, dst_fd, offset, count):
+        raise OSError(errno.EIO, os.strerror(errno.EIO))
+
+    monkeypatch.setattr(file_transfer, '_copy_range', failing_copy_range)
+    with pytest.raises(OSError) as error:
+        file_transfer.copy_file(source, str(tmp_path / "destination.bin"), streams=1, block_size=BLOCK_SIZE,
+                                retry_timeout=0.2)
+    assert error.value.errno == errno.EIO
@@ -0,0 +1,144 @@
+import itertools
+import threading
+import time
+import pytest
+from pipeline import Pipeline, PipelineCancelled
+
+TIMEOUT_SEC = 5
+
+
+def wait_in_thread(pipeline):
+    """Runs pipeline.wait() with a timeout, so a stage that is never woken up fails the test instead of hanging it."""
+    outcome = {}
+
+    def wait():
+        try:
+            pipeline.wait()
+        except BaseException as e:
+            outcome['error'] = e
+
+    thread = threading.Thread(target=wait, daemon=True)
+    thread.start()
+    thread.join(TIMEOUT_SEC)
+    assert not thread.is_alive(), "the pipeline did not finish"
+    return outcome.get('error')
+
+
+def test_put_blocks_on_a_full_channel():
+    pipeline = Pipeline()
+    channel = pipeline.channel("items", maxsize=2)
+    put = []
+    consume = threading.Event()
+    received = []
+
+    def produce():
+        for item in range(5):
+            channel.put(item)
+            put.append(item)
+
+    def receive():
+        consume.wait()
+        received.extend(channel)
+
+    pipeline.stage("produce", produce, outputs=(channel,))
+    pipeline.stage("receive", receive)
+    time.sleep(0.2)
+    assert put == [0, 1]
+    consume.set()
+    assert wait_in_thread(pipeline) is None
+    assert received == list(range(5))
+
+
+def test_failing_stage_cancels_waiting_stages():
+    pipeline = Pipeline()
+    full = pipeline.channel("full", maxsize=1)
+    empty = pipeline.channel("empty")
+    cancelled = []
+
+    def produce():
+        # Nothing reads 'full', so this blocks on the second item
+        try:
+            for item in itertools.count():
+                full.put(item)
+        except PipelineCancelled:
+            cancelled.append("produce")
+            raise
+
+    def receive():
+        try:
+            for _ in empty:
+                pass
+        except PipelineCancelled:
+            cancelled.append("receive")
+            raise
+
+    def fail():
+        time.sleep(0.2)
+        raise ValueError("stage failed")
+
+    pipeline.stage("produce", produce, outputs=(empty,))
+    pipeline.stage("receive", receive)
+    pipeline.stage("fail", fail)
+    error = wait_in_thread(pipeline)
+    assert isinstance(error, ValueError)
+    assert sorted(cancelled) == ["produce", "receive"]
+
+
+def test_channel_closes_after_its_last_producer():
+    pipeline = Pipeline()
+    channel = pipeline.channel("items", producers=2)
+    second_may_finish = threading.Event()
+    received = []
+    done = threading.Event()
+
+    def first():
+        channel.put("first")
+
+    def second():
+        second_may_finish.wait()
+        channel.put("second")
+
+    def receive():
+        received.extend(channel)
+        done.set()
+
+    pipeline.stage("first", first, outputs=(channel,))
+    pipeline.stage("second", second, outputs=(channel,))
+    pipeline.stage("receive", receive)
+    time.sleep(0.2)
+    # The first producer is finished, the channel stays open for the second one
+    assert not done.is_set()
+    second_may_finish.set()
+    assert wait_in_thread(pipeline) is None
+    assert received == ["first", "second"]
+
+
+@pytest.mark.parametrize('interleave, expected', [
+    (False, [1, 3, 3, 5, 7, 9]),
+    (True, [9, 1, 7, 3, 5, 3]),
+])
+def test_priority_channel_order(interleave, expected):
+    pipeline = Pipeline()
+    channel = pipeline.channel("items", key=lambda item: item[0], interleave=interleave)
+    for sequence, key in enumerate([5, 3, 9, 1, 3, 7]):
+        channel.put((key, sequence))
+    channel.close()
+    items = list(channel)
+    assert [key for key, _ in items] == expected
+    # Items with the same key keep the order they were put in
+    assert [sequence for key, sequence in items if key == 3] == [1, 4]
+
+
+def test_iterate_yields_none_while_idle():
+    pipeline = Pipeline()
+    channel = pipeline.channel("items")
+    received = []
+    for item in channel.iterate(idle_timeout=0.05):
+        if item is None:
+            if not received:
+                channel.put("item")
+                channel.close()
+            received.append(None)
+        else:
+            received.append(item)
+    assert received == [None, "item"]
@@ -0,0 +1,32 @@
+import numpy
+import pytest
+import tifffile
+from tiff_streaming import OUTPUT_FORMATS, hash_tiff_pixels, stream_recompress
+
+STACK = (numpy.arange(6 * 700 * 600, dtype='uint32') % 5000).astype('uint16').reshape(6, 700, 600)
+# Large enough to keep pages whole, and small enough to make them tiled
+MEMORY_BUDGETS = (1024 ** 3, 100000)
+
+
+def write_stack(path, layout):
+    if layout == 'truncated':
+        # Only the first IFD is written, the other pages follow it contiguously
+        tifffile.imwrite(path, STACK, truncate=True)
+    elif layout == 'imagej_truncated':
+        # Like ImageJ hyperstacks over 4 GB
+        tifffile.imwrite(path, STACK.reshape(2, 3, *STACK.shape[1:]), imagej=True, truncate=True)
+    else:
+        tifffile.imwrite(path, STACK)
+
+
+@pytest.mark.parametrize('layout', ['pages', 'truncated', 'imagej_truncated'])
+@pytest.mark.parametrize('output_format', OUTPUT_FORMATS)
+@pytest.mark.parametrize('memory_budget_bytes', MEMORY_BUDGETS)
+def test_stream_recompress_keeps_pixels(tmp_path, layout, output_format, memory_budget_bytes):
+    input_path, output_path = str(tmp_path / 'input.tif'), str(tmp_path / 'output.tif')
+    write_stack(input_path, layout)
+    timings = stream_recompress(input_path, output_path, dict(compression='zlib'), memory_budget_bytes,
+                                output_format=output_format, pixel_hash=True)
+    assert numpy.array_equal(tifffile.imread(output_path).reshape(STACK.shape), STACK)
+    assert timings['pixel_hash'] == hash_tiff_pixels(output_path, memory_budget_bytes)
+    assert timings['pixel_hash'] == hash_tiff_pixels(input_path, memory_budget_bytes)
@@ -0,0 +1,463 @@
+import hashlib
+import io
+import json
+import logging
+import os
+import tempfile
+import time
+import numpy
+import tifffile
+
+DEFAULT_MEMORY_BUDGET_MB = 1024
+OUTPUT_TILE_SIZE = 512
+# 'tiff' keeps the layout of the input, 'tiled' always writes tiles, the pyramid formats add subresolution levels
+OUTPUT_FORMATS = ('tiff', 'tiled', 'pyramid', 'ome_pyramid')
+# Subresolution levels are added, halving the size each time, until the image is smaller than this
+PYRAMID_MIN_LEVEL_SIZE = OUTPUT_TILE_SIZE
+# Subresolution pixels average at most this many pixels along each axis, deeper levels skip the rows and columns between
+PYRAMID_AVERAGE_FACTOR = 4
+# Every level halves both axes, so all subresolution levels together hold at most a third of the full resolution
+PYRAMID_LEVELS_SIZE_FRACTION = 1 / 3
+# Like tifffile.imwrite, switch to BigTIFF before a classic TIFF file would overflow
+BIGTIFF_MIN_BYTES = 2 ** 32 - 2 ** 25
+# Pixel data is added to the verification hash in chunks of this size, so memory-mapped pages are streamed
+PIXEL_HASH_CHUNK_BYTES = 16 * 1024 * 1024
+RATIO_ESTIMATE_SAMPLE_PAGES = 3
+RATIO_ESTIMATE_SAMPLE_BYTES = 4 * 1024 * 1024
+# Codecs taking a compression level, lzw has none
+LEVEL_COMPRESSIONS = ('zlib', 'zstd', 'jpeg_2000_lossy')
+# Parsed once, tifffile versions after 2022.7.28 take the compression level in a separate argument
+TIFFFILE_VERSION = tuple(int(part) for part in tifffile.__version__.split('.')[:3] if part.isdigit())
+
+
+def get_write_kwargs(compression, quality, threads, level=None, predictor=False):
+    """
+    Returns the compression arguments for TiffWriter.write, depending on the installed tifffile version.
+    'quality' is the level of jpeg_2000_lossy, 'level' the one of the lossless codecs. The horizontal differencing
+    predictor is only used by the lossless codecs.
+    """
+    if compression == "jpeg_2000_lossy":
+        level, predictor = quality, False
+    if compression not in LEVEL_COMPRESSIONS:
+        level = None
+    if TIFFFILE_VERSION > (2022, 7, 28):
+        write_kwargs = dict(compression=compression, maxworkers=threads)
+        if level is not None:
+            write_kwargs['compressionargs'] = {'level': level}
+    else:
+        write_kwargs = dict(compression=(compression, level), maxworkers=threads)
+    if predictor:
+        write_kwargs['predictor'] = True
+    return write_kwargs
+
+
+def _page_array(page, byteorder, use_memmap):
+    """
+    Returns the pixel data of one page. Uncompressed contiguous pages are memory-mapped,
+    so tiles can be sliced out of them without decoding the whole page into RAM.
+    """
+    if use_memmap and page.is_memmappable:
+        return numpy.memmap(
+            page.parent.filehandle.path,
+            dtype=numpy.dtype(byteorder + page.dtype.char),
+            mode='r',
+            offset=page.dataoffsets[0],
+            shape=page.shape)
+    return page.asarray()
+
+
+def _iter_pages(series, byteorder, use_memmap):
+    """
+    Yields the data of every page of the series in the shape of its first page.
+    Files storing only the first IFD of many contiguous pages, like ImageJ hyperstacks over 4 GB or files written by
+    tifffile with 'truncate', are memory-mapped as a whole and yielded a page at a time.
+    """
+    keyframe = series.keyframe
+    page_count = int(numpy.prod(series.shape)) // int(numpy.prod(keyframe.shape))
+    if len(series.pages) >= page_count:
+        for page in series.pages:
+            yield _page_array(page, byteorder, use_memmap).reshape(page.shape)
+        return
+    if series.dataoffset is not None:
+        data = numpy.memmap(
+            series.parent.filehandle.path,
+            dtype=numpy.dtype(byteorder + keyframe.dtype.char),
+            mode='r',
+            offset=series.dataoffset,
+            shape=(page_count,) + tuple(keyframe.shape))
+    else:
+        # Decoded into a temporary memory-mapped file, so the series is not held in memory
+        data = series.asarray(out='memmap').reshape((page_count,) + tuple(keyframe.shape))
+    for index in range(page_count):
+        yield data[index]
+
+
+def _iter_tiles(plane, tile):
+    """Yields tiles of a 2D (or 2D + contiguous samples) plane in row-major order, padding edge tiles."""
+    for y in range(0, plane.shape[0], tile[0]):
+        for x in range(0, plane.shape[1], tile[1]):
+            chunk = numpy.asarray(plane[y:y + tile[0], x:x + tile[1]])
+            if chunk.shape[:2] != tuple(tile):
+                pad = [(0, tile[0] - chunk.shape[0]), (0, tile[1] - chunk.shape[1])]
+                pad += [(0, 0)] * (chunk.ndim - 2)
+                chunk = numpy.pad(chunk, pad)
+            yield chunk
+
+
+def _pixel_hasher():
+    return hashlib.blake2b(digest_size=32)
+
+
+def _hash_pixels(hasher, data):
+    """Adds pixel values to the hash in little-endian C order, a chunk at a time."""
+    flat = data.reshape(-1)
+    dtype = flat.dtype.newbyteorder('<')
+    step = max(1, PIXEL_HASH_CHUNK_BYTES // max(1, flat.itemsize))
+    for start in range(0, flat.size, step):
+        hasher.update(numpy.ascontiguousarray(flat[start:start + step], dtype=dtype))
+
+
+def _hash_tile_rows(hasher, page):
+    """Adds a tiled page to the hash one row of tiles at a time, without decoding the whole page."""
+    keyframe = page.keyframe if page.keyframe is not None else page
+    band = band_key = None
+    for segment, (sample, _, y, x, _), shape in page.segments():
+        if (sample, y) != band_key:
+            if band is not None:
+                _hash_pixels(hasher, band)
+            band_key = (sample, y)
+            band = numpy.zeros((min(keyframe.tilelength, keyframe.imagelength - y), keyframe.imagewidth, shape[3]),
+                               keyframe.dtype)
+        if segment is not None:
+            # Edge tiles are padded to the full tile size
+            band[:, x:x + keyframe.tilewidth] = segment[0, :band.shape[0], :keyframe.imagewidth - x]
+    if band is not None:
+        _hash_pixels(hasher, band)
+
+
+def hash_tiff_pixels(input_path, memory_budget_bytes=DEFAULT_MEMORY_BUDGET_MB * 1024 * 1024):
+    """
+    Decodes a TIFF file page by page and returns a hash of the pixel data of all its series, the same hash
+    stream_recompress computes of its input with 'pixel_hash'. Subresolution levels are left out.
+    Tiled pages bigger than 'memory_budget_bytes' are decoded one row of tiles at a time.
+    """
+    hasher = _pixel_hasher()
+    with tifffile.TiffFile(input_path) as tif:
+        for series in tif.series:
+            keyframe = series.keyframe
+            if keyframe.is_tiled and keyframe.imagedepth == 1 and keyframe.nbytes > memory_budget_bytes:
+                for page in series.pages:
+                    _hash_tile_rows(hasher, page)
+                continue
+            for data in _iter_pages(series, tif.byteorder, use_memmap=True):
+                _hash_pixels(hasher, data)
+    return hasher.hexdigest()
+
+
+def _iter_series_data(series, byteorder, tile, use_memmap, hasher=None, levels=None):
+    """
+    Yields the series data page by page, or tile by tile if 'tile' is set.
+    Every page is added to 'hasher' as it is read, if given, and downsampled into the 'levels' of _level_buffers.
+    """
+    keyframe = series.keyframe
+    for index, data in enumerate(_iter_pages(series, byteorder, use_memmap=use_memmap or tile is not None)):
+        if hasher is not None:
+            _hash_pixels(hasher, data)
+        for factor, level in (levels or {}).items():
+            _downsample_page(data, keyframe, factor, tile, level[index])
+        if tile is None:
+            yield data
+            continue
+        planes = data if _spatial_axes(keyframe) == (1, 2) else (data,)
+        for plane in planes:
+            yield from _iter_tiles(plane, tile)
+        del data
+
+
+def _spatial_axes(keyframe):
+    """Returns the axes of rows and columns in the page shape."""
+    if keyframe.planarconfig == tifffile.PLANARCONFIG.SEPARATE and keyframe.samplesperpixel > 1:
+        return 1, 2
+    return 0, 1
+
+
+def _block_mean(block, factor):
+    """Averages 'factor' x 'factor' pixel blocks of a 2D (or 2D + samples) block, repeating edge pixels as needed."""
+    if factor == 1:
+        return block
+    pad = [(0, -block.shape[0] % factor), (0, -block.shape[1] % factor)] + [(0, 0)] * (block.ndim - 2)
+    block = numpy.pad(block, pad, mode='edge')
+    shape = (block.shape[0] // factor, factor, block.shape[1] // factor, factor) + block.shape[2:]
+    mean = block.reshape(shape).mean(axis=(1, 3))
+    if numpy.issubdtype(block.dtype, numpy.integer):
+        mean = numpy.rint(mean)
+    return mean.astype(block.dtype)
+
+
+def _downsample_plane(plane, factor, tile, out):
+    """
+    Writes 'plane' downsampled by 'factor' into 'out', reading one input block per output tile,
+    so a memory-mapped plane is never read as a whole.
+    """
+    average = min(factor, PYRAMID_AVERAGE_FACTOR)
+    step = factor // average
+    view = plane[::step, ::step]
+    for y in range(0, out.shape[0], tile[0]):
+        for x in range(0, out.shape[1], tile[1]):
+            block = numpy.asarray(view[y * average:(y + tile[0]) * average, x * average:(x + tile[1]) * average])
+            out[y:y + tile[0], x:x + tile[1]] = _block_mean(block, average)
+
+
+def _downsample_page(data, keyframe, factor, tile, out):
+    if _spatial_axes(keyframe) == (1, 2):
+        for plane, out_plane in zip(data, out):
+            _downsample_plane(plane, factor, tile, out_plane)
+    else:
+        _downsample_plane(data, factor, tile, out)
+
+
+def _level_buffers(series, factors, directory):
+    """
+    Returns temporary memory-mapped arrays for the subresolution levels of the series, by factor, in 'directory'.
+    They are filled while the full-resolution pages are read, so every page is read and decoded only once.
+    """
+    keyframe = series.keyframe
+    page_count = int(numpy.prod(series.shape)) // int(numpy.prod(keyframe.shape))
+    buffers = {}
+    for factor in factors:
+        page_shape = _level_shape(series, factor)[-len(keyframe.shape):]
+        buffers[factor] = numpy.memmap(tempfile.TemporaryFile(dir=directory), dtype=series.dtype, mode='w+',
+                                       shape=(page_count,) + tuple(page_shape))
+    return buffers
+
+
+def _iter_level_data(level, keyframe, tile):
+    """Yields the tiles of one subresolution level, page by page."""
+    for data in level:
+        planes = data if _spatial_axes(keyframe) == (1, 2) else (data,)
+        for plane in planes:
+            yield from _iter_tiles(plane, tile)
+
+
+def _pyramid_factors(series):
+    """Returns the downsampling factors of the subresolution levels of a series, an empty list if it cannot have any."""
+    keyframe = series.keyframe
+    if tuple(series.shape[-len(keyframe.shape):]) != tuple(keyframe.shape):
+        return []
+    row_axis, column_axis = _spatial_axes(keyframe)
+    size = max(keyframe.shape[row_axis], keyframe.shape[column_axis])
+    factors = []
+    factor = 2
+    while size // factor >= PYRAMID_MIN_LEVEL_SIZE:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+def _level_shape(series, factor):
+    keyframe = series.keyframe
+    page_shape = list(keyframe.shape)
+    for axis in _spatial_axes(keyframe):
+        page_shape[axis] = -(-page_shape[axis] // factor)
+    return tuple(series.shape[:-len(page_shape)]) + tuple(page_shape)
+
+
+def _timed(iterator, timings):
+    """Passes the items of 'iterator' through, adding the time spent producing them to timings['decode_sec']."""
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            timings['decode_sec'] += time.perf_counter() - start
+        yield item
+
+
+def _can_tile(series):
+    keyframe = series.keyframe
+    return keyframe.imagedepth == 1 and all(page is not None for page in series.pages)
+
+
+def stream_recompress(input_path, output_path, write_kwargs, memory_budget_bytes, use_memmap=False,
+                      output_format='tiff', pixel_hash=False, temp_dir=None):
+    """
+    Recompresses a TIFF file without loading it into memory as a whole.
+    Every series of the input is written as a series of the same shape and dtype, fed to TiffWriter page by page.
+    Pages bigger than 'memory_budget_bytes' are written tiled, reading one tile at a time from a memory-mapped input.
+    With 'use_memmap' all uncompressed contiguous pages are memory-mapped, so the encoder reads them straight
+    from the page cache without a copy in memory.
+    With 'output_format' 'tiled' every page is written tiled. 'pyramid' and 'ome_pyramid' also add subresolution
+    levels as SubIFDs (with OME-XML metadata for 'ome_pyramid'), so viewers only read the tiles they show at the zoom
+    level they show them. All levels are downsampled tile by tile while the input is read, into temporary files in
+    'temp_dir' (next to the output by default), so the input is read and decoded once.
+    Returns the time spent reading and decoding the input ('decode_sec') and compressing and writing ('encode_sec'),
+    with 'pixel_hash' also the hash_tiff_pixels hash of the input, computed while it is read ('pixel_hash').
+    """
+    timings = {'decode_sec': 0.0}
+    hasher = _pixel_hasher() if pixel_hash else None
+    start = time.perf_counter()
+    with tifffile.TiffFile(input_path) as tif:
+        bigtiff = sum(series.nbytes for series in tif.series) > BIGTIFF_MIN_BYTES
+        with tifffile.TiffWriter(output_path, bigtiff=bigtiff, ome=output_format == 'ome_pyramid') as tiff:
+            for series in tif.series:
+                keyframe = series.keyframe
+                tile = None
+                if (output_format != 'tiff' or keyframe.nbytes > memory_budget_bytes) and _can_tile(series):
+                    if keyframe.nbytes > memory_budget_bytes and not all(page.is_memmappable for page in series.pages):
+                        logging.warning(f"Pages of {input_path} are larger than the memory budget "
+                                        f"but are not memory-mappable, decoding them whole.")
+                    tile = (OUTPUT_TILE_SIZE, OUTPUT_TILE_SIZE)
+                factors = _pyramid_factors(series) if tile is not None and output_format.endswith('pyramid') else []
+                levels = _level_buffers(series, factors, temp_dir or os.path.dirname(os.path.abspath(output_path)))
+                layout = dict(
+                    dtype=series.dtype,
+                    photometric=keyframe.photometric,
+                    planarconfig=keyframe.planarconfig if keyframe.samplesperpixel > 1 else None,
+                    tile=tile,
+                    **write_kwargs)
+                tiff.write(
+                    _timed(_iter_series_data(series, tif.byteorder, tile, use_memmap, hasher, levels), timings),
+                    shape=series.shape,
+                    subifds=len(factors) or None,
+                    **layout)
+                for factor in factors:
+                    # A level and its temporary file are freed once it is written
+                    level = levels.pop(factor)
+                    tiff.write(
+                        _timed(_iter_level_data(level, keyframe, tile), timings),
+                        shape=_level_shape(series, factor),
+                        subfiletype=1,
+                        **layout)
+                    del level
+    timings['encode_sec'] = time.perf_counter() - start - timings['decode_sec']
+    if hasher is not None:
+        timings['pixel_hash'] = hasher.hexdigest()
+    return timings
+
+
+def _header_page_count(tif, page):
+    """Returns the number of images from ImageJ or tifffile metadata, None if it would take walking all IFDs."""
+    if tif.is_imagej:
+        return int(tif.imagej_metadata.get('images', 1))
+    if page.shaped_description is not None:
+        try:
+            shape = json.loads(page.shaped_description).get('shape')
+        except ValueError:
+            shape = None
+        if shape:
+            return max(1, int(numpy.prod(shape)) // int(numpy.prod(page.shape)))
+    return None
+
+
+def read_tiff_header(input_path):
+    """
+    Reads the compression tag, dtype, tiling and page count of a TIFF file from its first IFD, without any pixel data,
+    so it is cheap on remote files.
+    Returns a dict with 'is_image' False if the file is not a TIFF or has no image data.
+    """
+    header = {'is_image': False, 'compression': None, 'dtype': None, 'tiled': None, 'pages': 0}
+    try:
+        with tifffile.TiffFile(input_path) as tif:
+            try:
+                page = tif.pages[0]
+            except IndexError:
+                return header
+            if page.dtype is None or not page.shape:
+                return header
+            header.update(is_image=True, compression=int(page.compression), dtype=str(numpy.dtype(page.dtype)),
+                          tiled=bool(page.is_tiled), pages=_header_page_count(tif, page))
+    except ValueError:
+        # tifffile raises TiffFileError, a ValueError, for files that are not TIFF
+        pass
+    return header
+
+
+def _central_rows(data, keyframe, max_bytes):
+    """Returns a band of rows from the middle of a page, at most 'max_bytes' big."""
+    row_axis = 1 if keyframe.planarconfig == tifffile.PLANARCONFIG.SEPARATE and data.ndim == 3 else 0
+    if data.nbytes <= max_bytes:
+        return data
+    row_bytes = data.nbytes // data.shape[row_axis]
+    rows = max(1, max_bytes // row_bytes)
+    start = (data.shape[row_axis] - rows) // 2
+    index = [slice(None)] * data.ndim
+    index[row_axis] = slice(start, start + rows)
+    return data[tuple(index)]
+
+
+def _sample_pages(tif, sample_pages, sample_bytes):
+    """
+    Yields (page, keyframe, sample) for a few pages spread over the file, where the sample is
+    the whole page or a band of rows from the middle of big pages.
+    """
+    pages = [page for series in tif.series for page in series.pages if page is not None]
+    if not pages:
+        return
+    indices = sorted(set(numpy.linspace(0, len(pages) - 1, min(sample_pages, len(pages))).round().astype(int)))
+    for index in indices:
+        page = pages[index]
+        keyframe = page.keyframe if page.keyframe is not None else page
+        sample = _central_rows(_page_array(page, tif.byteorder, use_memmap=True).reshape(page.shape),
+                               keyframe, sample_bytes)
+        yield page, keyframe, sample
+
+
+def _write_sample(tiff, sample, keyframe, write_kwargs):
+    tiff.write(
+        numpy.ascontiguousarray(sample),
+        photometric=keyframe.photometric,
+        planarconfig=keyframe.planarconfig if keyframe.samplesperpixel > 1 else None,
+        **write_kwargs)
+
+
+def estimate_compression_ratio(input_path, write_kwargs, sample_pages=RATIO_ESTIMATE_SAMPLE_PAGES,
+                               sample_bytes=RATIO_ESTIMATE_SAMPLE_BYTES):
+    """
+    Predicts the compression ratio of a TIFF file by trial-compressing a few pages spread over the file in memory.
+    Only the sampled pages (or a band of rows from the middle of big pages) are read, so it is cheap on remote files.
+    Returns None if the file has no image data.
+    """
+    with tifffile.TiffFile(input_path) as tif:
+        stored_bytes = 0.0
+        buffer = io.BytesIO()
+        with tifffile.TiffWriter(buffer) as tiff:
+            for page, keyframe, sample in _sample_pages(tif, sample_pages, sample_bytes):
+                # Size the sample takes in the original file, which might already be compressed
+                stored_bytes += sum(page.databytecounts) * sample.nbytes / page.nbytes
+                _write_sample(tiff, sample, keyframe, write_kwargs)
+        if stored_bytes == 0:
+            return None
+        return stored_bytes / buffer.tell()
+
+
+def benchmark_codecs(input_paths, candidates, sample_pages=RATIO_ESTIMATE_SAMPLE_PAGES,
+                     sample_bytes=RATIO_ESTIMATE_SAMPLE_BYTES):
+    """
+    Trial-compresses the same pages, sampled from every file in 'input_paths', with each of the 'candidates'
+    (TiffWriter.write arguments) in memory.
+    Returns a (ratio, mb_per_sec) tuple per candidate, both relative to the uncompressed size of the samples,
+    or None if the files have no image data.
+    """
+    samples = []
+    for input_path in input_paths:
+        with tifffile.TiffFile(input_path) as tif:
+            samples += [(numpy.array(sample), keyframe)
+                        for _, keyframe, sample in _sample_pages(tif, sample_pages, sample_bytes)]
+    raw_bytes = sum(sample.nbytes for sample, _ in samples)
+    if raw_bytes == 0:
+        return None
+    results = []
+    for write_kwargs in candidates:
+        # Untimed warm-up, so loading the codec is not counted against the first candidate
+        with tifffile.TiffWriter(io.BytesIO()) as tiff:
+            _write_sample(tiff, *samples[0], write_kwargs)
+        buffer = io.BytesIO()
+        start = time.perf_counter()
+        with tifffile.TiffWriter(buffer) as tiff:
+            for sample, keyframe in samples:
+                _write_sample(tiff, sample, keyframe, write_kwargs)
+        encode_sec = max(time.perf_counter() - start, 1e-9)
+        results.append((raw_bytes / buffer.tell(), raw_bytes / 1024 ** 2 / encode_sec))
+    return results
@@ -0,0 +1,180 @@
+import hashlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+LEASE_DIR = "_compression_leases"
+DONE_SUFFIX = ".done"
+DEFAULT_LEASE_TTL_SEC = 600
+LEASE_HEARTBEAT_SEC = 30
+O_BINARY = getattr(os, 'O_BINARY', 0)
+
+
+class WorkLeases:
+    """
+    Lets several processes, on one or more computers, work through the same folder without processing a file twice.
+    A worker claims a file by creating a lease file in the LEASE_DIR folder with O_EXCL, which is atomic on local
+    disks and on SMB and NFS shares. Leases are named after the path relative to 'root', so every computer can mount
+    the share wherever it likes. The leases held are touched every 'heartbeat_interval' seconds; a lease not touched
+    for 'ttl' seconds belongs to a worker that crashed and is taken over. Clocks of the computers are assumed to agree
+    to well within 'ttl'.
+    Before its lease is released, the result for a file is written next to it as a '.done' record, which the other
+    workers check before processing the file. These records, not a shared database, are how workers see each other's
+    results, since SQLite's locking cannot be relied on over network shares. read_done_records collects them.
+    Use it as a context manager, or call close() to stop the heartbeat and release the remaining leases.
+    """
+
+    def __init__(self, root, ttl=DEFAULT_LEASE_TTL_SEC, heartbeat_interval=LEASE_HEARTBEAT_SEC):
+        self.root = root
+        self.ttl = ttl
+        self.heartbeat_interval = heartbeat_interval
+        self.lease_dir = os.path.join(root, LEASE_DIR)
+        os.makedirs(self.lease_dir, exist_ok=True)
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.held = {}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.heartbeat_thread = threading.Thread(target=self._heartbeat, args=(heartbeat_interval,), daemon=True)
+        self.heartbeat_thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _relative_path(self, path):
+        return os.path.relpath(path, self.root).replace(os.sep, '/')
+
+    def _lease_path(self, path, suffix=".lease"):
+        return os.path.join(self.lease_dir, hashlib.sha1(self._relative_path(path).encode()).hexdigest() + suffix)
+
+    def _create(self, lease_path, path):
+        try:
+            fd = os.open(lease_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | O_BINARY, 0o666)
+        except FileExistsError:
+            return False
+        try:
+            os.write(fd, f"{self.owner}\n{path}\n".encode())
+        finally:
+            os.close(fd)
+        return True
+
+    def _owner_of(self, lease_path):
+        try:
+            with open(lease_path, 'r') as lease:
+                return lease.readline().strip()
+        except OSError:
+            return None
+
+    def _is_stale(self, lease_path):
+        try:
+            return time.time() - os.stat(lease_path).st_mtime > self.ttl
+        except OSError:
+            return False
+
+    def acquire(self, path):
+        """Returns True if this worker now holds the lease of 'path', False if another worker holds it."""
+        lease_path = self._lease_path(path)
+        if not self._create(lease_path, path):
+            if not self._is_stale(lease_path):
+                return False
+            # Move the stale lease out of the way. Only one worker can rename it, the others get FileNotFoundError
+            tombstone = f"{lease_path}.{uuid.uuid4().hex}.stale"
+            try:
+                os.rename(lease_path, tombstone)
+            except OSError:
+                return False
+            if not self._is_stale(tombstone):
+                # Another worker took the stale lease over between the checks, give its new lease back
+                try:
+                    os.rename(tombstone, lease_path)
+                except OSError:
+                    pass
+                return False
+            logging.warning(f"Taking over the expired lease of {path} from {self._owner_of(tombstone)}")
+            os.remove(tombstone)
+            if not self._create(lease_path, path):
+                return False
+        with self.lock:
+            self.held[path] = lease_path
+        return True
+
+    def is_held(self, path):
+        """Checks on the share that the lease of 'path' still belongs to this worker, before an irreversible step."""
+        with self.lock:
+            lease_path = self.held.get(path)
+        return lease_path is not None and self._owner_of(lease_path) == self.owner
+
+    def release(self, path):
+        with self.lock:
+            lease_path = self.held.pop(path, None)
+        if lease_path is not None and self._owner_of(lease_path) == self.owner:
+            try:
+                os.remove(lease_path)
+            except OSError as e:
+                logging.warning(f"Could not remove the lease of {path}: {e}")
+
+    def record_done(self, path, record):
+        """
+        Stores the 'record' of a finished file, a dict with its 'status', 'size' and 'mtime', for the other workers.
+        It is written to a new file created with O_EXCL and renamed over the old record, so readers never see half.
+        """
+        done_path = self._lease_path(path, DONE_SUFFIX)
+        temp_path = f"{done_path}.{uuid.uuid4().hex}.tmp"
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | O_BINARY, 0o666)
+        try:
+            os.write(fd, json.dumps({**record, 'path': self._relative_path(path)}).encode())
+        finally:
+            os.close(fd)
+        os.replace(temp_path, done_path)
+
+    def is_done(self, path, size, mtime, statuses):
+        """Returns True if a worker recorded 'path' with one of 'statuses' at this size and modification time."""
+        record = _read_record(self._lease_path(path, DONE_SUFFIX))
+        return (record is not None and record.get('status') in statuses
+                and (record.get('size'), record.get('mtime')) == (size, mtime))
+
+    def _heartbeat(self, interval):
+        while not self.stop_event.wait(interval):
+            with self.lock:
+                held = list(self.held.items())
+            for path, lease_path in held:
+                try:
+                    os.utime(lease_path, None)
+                except OSError as e:
+                    logging.warning(f"Could not renew the lease of {path}: {e}")
+
+    def close(self):
+        self.stop_event.set()
+        self.heartbeat_thread.join()
+        with self.lock:
+            paths = list(self.held)
+        for path in paths:
+            self.release(path)
+
+
+def _read_record(done_path):
+    try:
+        with open(done_path, 'r') as done_file:
+            return json.load(done_file)
+    except (OSError, ValueError):
+        return None
+
+
+def read_done_records(root):
+    """
+    Returns (record path, record) for every file finished by cooperative workers under 'root', see
+    WorkLeases.record_done. The 'path' of a record is relative to 'root', with '/' separators.
+    """
+    try:
+        with os.scandir(os.path.join(root, LEASE_DIR)) as entries:
+            done_paths = [entry.path for entry in entries if entry.name.endswith(DONE_SUFFIX)]
+    except FileNotFoundError:
+        return []
+    records = [(done_path, _read_record(done_path)) for done_path in done_paths]
+    return [(done_path, record) for done_path, record in records if record is not None]